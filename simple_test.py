@@ -3,27 +3,115 @@ Simple RTU Connection Tester
 Kiểm tra kết nối Modbus RTU cơ bản không qua connection pool
 """
 
+import array
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import io
+import itertools
+import json
+import logging
+import os
+import pathlib
+import select
+import struct
+import sys
+import threading
 import time
+import weakref
 import serial
-from pymodbus.client import ModbusSerialClient
+from pymodbus.client import AsyncModbusSerialClient
 from pymodbus.exceptions import ModbusIOException, ConnectionException
+from pymodbus.pdu import ExceptionResponse
 
-def list_available_ports():
-    """Liệt kê tất cả COM ports có sẵn"""
+# Kiểu kết quả lỗi mà client trả về (thay cho result.isError() trong vòng probe)
+_ERROR_RESULTS = (ExceptionResponse, ModbusIOException)
+
+log = logging.getLogger("rtu_tester")
+
+# Thread worker của test_all_ports đang gom log vào handler riêng -> handler console bỏ qua
+_capturing_threads = set()
+
+def _setup_logging(level=logging.INFO):
+    """Cấu hình logger rtu_tester: chỉ in message, không prefix"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handler.addFilter(lambda record: record.thread not in _capturing_threads)
+    log.addHandler(handler)
+    log.setLevel(level)
+    log.propagate = False
+
+_PORTS_CACHE_TTL = 5  # giây
+
+@functools.lru_cache(maxsize=1)
+def _list_ports_cached(bucket):
+    """Kết quả comports() cho 1 khung thời gian (bucket = monotonic // TTL)"""
     import serial.tools.list_ports
-    ports = list(serial.tools.list_ports.comports())
-    print("=== Available COM Ports ===")
+    return tuple(serial.tools.list_ports.comports())
+
+def list_available_ports():
+    """Liệt kê tất cả COM ports có sẵn (cache trong _PORTS_CACHE_TTL giây)"""
+    ports = _list_ports_cached(int(time.monotonic() // _PORTS_CACHE_TTL))
+    log.info("=== Available COM Ports ===")
     if not ports:
-        print("❌ No COM ports found!")
+        log.info("❌ No COM ports found!")
         return []
     
     for port in ports:
-        print(f"✅ {port.device} - {port.description}")
+        log.info(f"✅ {port.device} - {port.description}")
     return [port.device for port in ports]
 
+# Kết quả chỉnh latency timer theo port (cả khi lỗi): mỗi port chỉ thử và cảnh báo 1 lần
+_low_latency_ports = {}
+
+def _set_low_latency(port):
+    """Hạ latency timer của USB-serial (FTDI/CH340) về 1ms trước khi mở port (mặc định 16ms)"""
+    cached = _low_latency_ports.get(port)
+    if cached is not None:
+        return cached
+    
+    ok = False
+    if sys.platform.startswith('linux'):
+        # /dev/ttyUSB0 -> /sys/bus/usb-serial/devices/ttyUSB0/latency_timer
+        name = os.path.basename(os.path.realpath(port))
+        path = f"/sys/bus/usb-serial/devices/{name}/latency_timer"
+        try:
+            with open(path, 'wb') as f:
+                f.write(b'1')
+            ok = True
+        except OSError as e:
+            log.info(f"⚠️ Cannot set latency_timer for {port}: {e}")
+    elif sys.platform == 'win32':
+        try:
+            import ftd2xx
+            ports = _list_ports_cached(int(time.monotonic() // _PORTS_CACHE_TTL))
+            serial_number = next(
+                (p.serial_number for p in ports if p.device == port),
+                None
+            )
+            if serial_number:
+                dev = ftd2xx.openEx(serial_number.encode())
+                try:
+                    dev.setLatencyTimer(1)
+                    ok = True
+                finally:
+                    dev.close()
+        except ImportError:
+            log.info("⚠️ ftd2xx not installed - skip latency timer tweak")
+        except Exception as e:
+            log.info(f"⚠️ Cannot set FTDI latency timer for {port}: {e}")
+    
+    _low_latency_ports[port] = ok
+    if ok:
+        log.info(f"⚡ Latency timer set to 1ms for {port}")
+    return ok
+
 def test_serial_port_basic(port, baudrate=9600):
     """Test cơ bản COM port có mở được không"""
-    print(f"\n=== Testing Serial Port: {port} ===")
+    log.info(f"\n=== Testing Serial Port: {port} ===")
+    _set_low_latency(port)
     try:
         ser = serial.Serial(
             port=port,
@@ -33,317 +121,583 @@ def test_serial_port_basic(port, baudrate=9600):
             stopbits=1,
             timeout=1.0
         )
-        print(f"✅ Port {port} opened successfully")
+        log.info(f"✅ Port {port} opened successfully")
         ser.close()
-        print(f"✅ Port {port} closed successfully")
+        log.info(f"✅ Port {port} closed successfully")
         return True
     except Exception as e:
-        print(f"❌ Cannot open port {port}: {e}")
+        log.info(f"❌ Cannot open port {port}: {e}")
         return False
 
-def test_modbus_rtu_connection(port, baudrate=9600, unit_id=1, timeout=None, parity='N', bytesize=8, stopbits=1):
-    """Test kết nối Modbus RTU với cấu hình serial chi tiết"""
+# ===== CRC16 Modbus nhanh (bảng tra 256 phần tử / fastcrc) =====
+def _build_crc_table():
+    """Tạo bảng tra CRC16 Modbus (đa thức 0xA001) một lần khi import"""
+    table = array.array('H')
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_CRC16_TABLE = _build_crc_table()
+
+def _crc16_modbus(data):
+    """CRC16 Modbus theo bảng tra: 1 lookup + XOR mỗi byte"""
+    crc = 0xFFFF
+    for b in data:
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ b) & 0xFF]
+    return crc
+
+def build_rtu_frame(unit, fc, addr, qty):
+    """Tạo frame Modbus RTU: [unit][fc][addr_hi][addr_lo][qty_hi][qty_lo][crc_lo][crc_hi]"""
+    pdu = struct.pack('>BBHH', unit, fc, addr, qty)
+    return pdu + struct.pack('<H', _crc16_modbus(pdu))
+
+_fast_crc_installed = False
+
+def _install_fast_crc():
+    """Dùng fastcrc (C) cho CRC của framer RTU pymodbus nếu đã cài; không có thì giữ nguyên pymodbus"""
+    global _fast_crc_installed
+    if _fast_crc_installed:
+        return True
     
-    # Tính timeout tự động dựa trên baudrate nếu không được chỉ định
-    if timeout is None:
-        # Công thức: timeout = max(2.0, 15000 / baudrate) để đảm bảo đủ thời gian cho response
-        timeout = max(2.0, 15000 / baudrate)
+    try:
+        from fastcrc.crc16 import modbus as _fc
+    except ImportError:
+        # pymodbus 3.x đã tính CRC bằng bảng tra -> không thay bằng 1 bảng tra khác
+        return False
     
-    print(f"\n=== Testing Modbus RTU Connection ===")
-    print(f"Port: {port}")
-    print(f"Baudrate: {baudrate}")
-    print(f"Unit ID: {unit_id}")
-    print(f"Timeout: {timeout:.1f}s")
-    print(f"Serial config: {bytesize}{parity}{stopbits}")
+    def compute_crc(data):
+        # pymodbus dùng CRC đã đảo byte (pack '>H' -> byte thấp đi trước)
+        crc = _fc(bytes(data))
+        return ((crc << 8) & 0xFF00) | (crc >> 8)
     
-    client = None
     try:
-        # Tạo client
-        client = ModbusSerialClient(
-            port=port,
-            baudrate=baudrate,
-            bytesize=8,
-            parity='N',
-            stopbits=1,
-            timeout=timeout
-        )
-        
-        # Kết nối
-        print("🔌 Connecting...")
-        connected = client.connect()
-        
-        if not connected:
-            print("❌ Failed to connect to Modbus RTU")
-            return False
-            
-        print("✅ Connected to Modbus RTU")
-        
-        # Test đọc một số function codes phổ biến
-        test_results = {}
-        
-        # Test FC03 - Read Holding Registers
-        print("\n--- Testing FC03 (Read Holding Registers) ---")
-        for addr in [0, 1, 40001, 40002]:  # Test một số địa chỉ phổ biến
+        from pymodbus.framer.rtu import FramerRTU
+        FramerRTU.compute_CRC = staticmethod(compute_crc)
+        _fast_crc_installed = True
+    except ImportError:
+        pass
+    
+    try:
+        import pymodbus.utilities as utilities
+        if hasattr(utilities, 'computeCRC'):
+            utilities.computeCRC = compute_crc
+            _fast_crc_installed = True
+    except ImportError:
+        pass
+    
+    return _fast_crc_installed
+
+# Lock theo port (mỗi event loop 1 bộ): Modbus RTU không cho phép pipeline trên cùng 1 bus
+_port_locks = weakref.WeakKeyDictionary()
+
+def _get_port_lock(port):
+    """Lấy asyncio.Lock dùng chung cho 1 COM port trong event loop hiện tại"""
+    locks = _port_locks.setdefault(asyncio.get_running_loop(), {})
+    lock = locks.get(port)
+    if lock is None:
+        lock = locks[port] = asyncio.Lock()
+    return lock
+
+def _frame_gap(baudrate):
+    """Khoảng lặng 3.5 ký tự (11 bit/ký tự) giữa 2 frame RTU"""
+    return 3.5 * 11 / baudrate
+
+# Các function code cần probe:
+# (FC, tên, nhãn địa chỉ, hàm đọc của client, địa chỉ test, offset kiểu 40001/10001, thuộc tính giá trị)
+_FC_PROBES = (
+    ("FC03", "Read Holding Registers", "Address", "read_holding_registers", (0, 1, 40001, 40002), 40001, "registers"),
+    ("FC01", "Read Coils", "Coil", "read_coils", (0, 1, 10001, 10002), 10001, "bits"),
+    ("FC04", "Read Input Registers", "Input Register", "read_input_registers", (0, 1), None, "registers"),
+)
+
+def _group_contiguous(addrs, max_count=125):
+    """Gom các địa chỉ liên tiếp thành các block (start, count) để đọc 1 lần"""
+    blocks = []
+    for addr in sorted(set(addrs)):
+        if blocks and addr == blocks[-1][0] + blocks[-1][1] and blocks[-1][1] < max_count:
+            blocks[-1][1] += 1
+        else:
+            blocks.append([addr, 1])
+    return [(start, count) for start, count in blocks]
+
+async def _bus_read(read, address, count, unit_id, lock, gap):
+    """1 request trên bus RTU: chỉ giữ lock của port trong request + khoảng lặng -> (result, latency ms)"""
+    async with lock:
+        try:
+            t0 = time.perf_counter_ns()
+            result = await read(address, count=count, slave=unit_id)
+            return result, (time.perf_counter_ns() - t0) / 1e6
+        finally:
+            await asyncio.sleep(gap)
+
+async def _probe_all(client, unit_id, port, baudrate):
+    """Chạy các vòng FC03/FC01/FC04 trên async client (lock của port giữ theo từng request)"""
+    test_results = {}
+    lock = _get_port_lock(port)
+    gap = _frame_gap(baudrate)
+
+    for fc, title, label, method, addrs, offset, attr in _FC_PROBES:
+        log.info("\n--- Testing %s (%s), Unit %s ---", fc, title, unit_id)
+        read = getattr(client, method)
+        
+        # Normalize address (40001 -> 0, 10001 -> 0)
+        normalized = {
+            addr: (addr - offset if offset and addr >= offset else addr)
+            for addr in addrs
+        }
+        
+        # Mỗi block địa chỉ liên tiếp chỉ tốn 1 round-trip
+        for start, count in _group_contiguous(normalized.values()):
+            members = [addr for addr, norm in normalized.items() if start <= norm < start + count]
             try:
-                start_time = time.time()
-                
-                # Normalize address
-                read_addr = addr
-                if addr >= 40001:
-                    read_addr = addr - 40001
+                result, latency = await _bus_read(read, start, count, unit_id, lock, gap)
                 
-                result = client.read_holding_registers(read_addr, 1, slave=unit_id)
-                latency = (time.time() - start_time) * 1000
-                
-                if result.isError():
-                    print(f"❌ Address {addr}: {result}")
-                    test_results[f"FC03_addr_{addr}"] = f"Error: {result}"
+                if isinstance(result, _ERROR_RESULTS):
+                    for addr in members:
+                        log.info("❌ [unit %s] %s %s: %s", unit_id, label, addr, result)
+                        test_results[f"{fc}_addr_{addr}"] = f"Error: {result}"
                 else:
-                    value = result.registers[0]
-                    print(f"✅ Address {addr}: {value} (latency: {latency:.1f}ms)")
-                    test_results[f"FC03_addr_{addr}"] = {"value": value, "latency_ms": latency}
+                    values = getattr(result, attr)
+                    for addr in members:
+                        value = values[normalized[addr] - start]
+                        log.info("✅ [unit %s] %s %s: %s (latency: %.1fms)", unit_id, label, addr, value, latency)
+                        test_results[f"{fc}_addr_{addr}"] = {"value": value, "latency_ms": latency}
                     
             except Exception as e:
-                print(f"❌ Address {addr}: Exception: {e}")
-                test_results[f"FC03_addr_{addr}"] = f"Exception: {e}"
-        
-        # Test FC01 - Read Coils
-        print("\n--- Testing FC01 (Read Coils) ---")
-        for addr in [0, 1, 10001, 10002]:
-            try:
-                start_time = time.time()
+                for addr in members:
+                    log.info("❌ [unit %s] %s %s: Exception: %s", unit_id, label, addr, e)
+                    test_results[f"{fc}_addr_{addr}"] = f"Exception: {e}"
+
+    return test_results
+
+def _make_async_client(port, baudrate, timeout):
+    """Tạo AsyncModbusSerialClient với cấu hình serial 8N1"""
+    return AsyncModbusSerialClient(
+        port=port,
+        baudrate=baudrate,
+        bytesize=8,
+        parity='N',
+        stopbits=1,
+        timeout=timeout
+    )
+
+# Event loop dùng chung (mỗi thread 1 loop): client async mở ở lần gọi trước vẫn dùng lại được
+_thread_state = threading.local()
+
+def _run_async(coro):
+    """Chạy coroutine trên event loop dùng chung của thread hiện tại"""
+    loop = getattr(_thread_state, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _thread_state.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coro)
+
+def _close_thread_loop():
+    """Đóng event loop của thread hiện tại (worker của thread pool xong việc)"""
+    loop = getattr(_thread_state, 'loop', None)
+    if loop is not None and not loop.is_closed():
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+    _thread_state.loop = None
+
+def open_modbus_client(port, baudrate, timeout):
+    """Mở sẵn 1 AsyncModbusSerialClient để dùng lại cho nhiều lần probe (None nếu không kết nối được)"""
+    _install_fast_crc()
+    client = _make_async_client(port, baudrate, timeout)
+    log.info(f"🔌 Connecting {port} @ {baudrate}...")
+    if not _run_async(client.connect()):
+        log.info("❌ Failed to connect to Modbus RTU")
+        client.close()
+        return None
+    log.info("✅ Connected to Modbus RTU")
+    return client
+
+def test_modbus_rtu_connection(port, baudrate=9600, unit_id=1, timeout=None, parity='N', bytesize=8, stopbits=1, client=None):
+    """Test kết nối Modbus RTU với cấu hình serial chi tiết (truyền client đã kết nối để dùng lại)"""
+    
+    # Tính timeout tự động dựa trên baudrate nếu không được chỉ định
+    if timeout is None:
+        # Công thức: timeout = max(2.0, 15000 / baudrate) để đảm bảo đủ thời gian cho response
+        timeout = max(2.0, 15000 / baudrate)
+    
+    _install_fast_crc()
+    
+    log.info(f"\n=== Testing Modbus RTU Connection ===")
+    log.info(f"Port: {port}")
+    log.info(f"Baudrate: {baudrate}")
+    log.info(f"Unit ID: {unit_id}")
+    log.info(f"Timeout: {timeout:.1f}s")
+    log.info(f"Serial config: {bytesize}{parity}{stopbits}")
+    
+    async def _run(client):
+        owns_client = client is None
+        try:
+            if owns_client:
+                # Tạo client
+                client = _make_async_client(port, baudrate, timeout)
                 
-                read_addr = addr
-                if addr >= 10001:
-                    read_addr = addr - 10001
-                    
-                result = client.read_coils(read_addr, 1, slave=unit_id)
-                latency = (time.time() - start_time) * 1000
+                # Kết nối
+                log.info("🔌 Connecting...")
+                connected = await client.connect()
                 
-                if result.isError():
-                    print(f"❌ Coil {addr}: {result}")
-                    test_results[f"FC01_addr_{addr}"] = f"Error: {result}"
-                else:
-                    value = result.bits[0]
-                    print(f"✅ Coil {addr}: {value} (latency: {latency:.1f}ms)")
-                    test_results[f"FC01_addr_{addr}"] = {"value": value, "latency_ms": latency}
+                if not connected:
+                    log.info("❌ Failed to connect to Modbus RTU")
+                    return False
                     
-            except Exception as e:
-                print(f"❌ Coil {addr}: Exception: {e}")
-                test_results[f"FC01_addr_{addr}"] = f"Exception: {e}"
-        
-        # Test FC04 - Read Input Registers
-        print("\n--- Testing FC04 (Read Input Registers) ---")
-        for addr in [0, 1]:
-            try:
-                start_time = time.time()
-                result = client.read_input_registers(addr, 1, slave=unit_id)
-                latency = (time.time() - start_time) * 1000
-                
-                if result.isError():
-                    print(f"❌ Input Register {addr}: {result}")
-                    test_results[f"FC04_addr_{addr}"] = f"Error: {result}"
-                else:
-                    value = result.registers[0]
-                    print(f"✅ Input Register {addr}: {value} (latency: {latency:.1f}ms)")
-                    test_results[f"FC04_addr_{addr}"] = {"value": value, "latency_ms": latency}
-                    
-            except Exception as e:
-                print(f"❌ Input Register {addr}: Exception: {e}")
-                test_results[f"FC04_addr_{addr}"] = f"Exception: {e}"
-        
-        return test_results
-        
-    except Exception as e:
-        print(f"❌ Modbus RTU test failed: {e}")
-        return False
-    finally:
-        if client:
+                log.info("✅ Connected to Modbus RTU")
+            else:
+                log.info("♻️ Reusing connected Modbus client")
+            
+            # Test đọc một số function codes phổ biến
+            return await _probe_all(client, unit_id, port, baudrate)
+            
+        except Exception as e:
+            log.info(f"❌ Modbus RTU test failed: {e}")
+            return False
+        finally:
+            if owns_client and client:
+                try:
+                    client.close()
+                    log.info("🔌 Connection closed")
+                except:
+                    pass
+    
+    return _run_async(_run(client))
+
+def test_modbus_rtu_units(port, baudrate, unit_ids, timeout=None):
+    """Test nhiều unit ID trên cùng bus với 1 async client (probe các unit xen kẽ, từng request tuần tự theo lock của port)"""
+    if timeout is None:
+        timeout = max(2.0, 15000 / baudrate)
+    
+    _install_fast_crc()
+    
+    log.info(f"\n=== Testing Modbus RTU Units {list(unit_ids)} @ {baudrate} ===")
+    
+    async def _run():
+        client = _make_async_client(port, baudrate, timeout)
+        try:
+            if not await client.connect():
+                log.info("❌ Failed to connect to Modbus RTU")
+                return {f"unit_{u}": False for u in unit_ids}
+            results = await asyncio.gather(
+                *(_probe_all(client, u, port, baudrate) for u in unit_ids),
+                return_exceptions=True
+            )
+            return {
+                f"unit_{u}": (False if isinstance(r, Exception) else r)
+                for u, r in zip(unit_ids, results)
+            }
+        finally:
             try:
                 client.close()
-                print("🔌 Connection closed")
+                log.info("🔌 Connection closed")
             except:
                 pass
+    
+    return _run_async(_run())
+
+# Các cấu hình phổ biến (baudrate, unit_id)
+Cfg = collections.namedtuple('Cfg', 'baudrate unit_id')
+CONFIGS = (
+    Cfg(9600, 1),
+    Cfg(19200, 1),
+    Cfg(38400, 1),
+    Cfg(9600, 2),
+    Cfg(9600, 3),
+)
 
 def test_multiple_configurations(port):
     """Test với nhiều cấu hình baudrate và unit ID khác nhau"""
-    print(f"\n=== Testing Multiple Configurations for {port} ===")
-    
-    # Các cấu hình phổ biến
-    configs = [
-        {"baudrate": 9600, "unit_id": 1},
-        {"baudrate": 19200, "unit_id": 1},
-        {"baudrate": 38400, "unit_id": 1},
-        {"baudrate": 9600, "unit_id": 2},
-        {"baudrate": 9600, "unit_id": 3},
-    ]
+    log.info(f"\n=== Testing Multiple Configurations for {port} ===")
     
     successful_configs = []
     
-    for config in configs:
-        print(f"\n--- Testing: Baudrate={config['baudrate']}, Unit ID={config['unit_id']} ---")
-        
+    # Gom theo baudrate: mỗi baudrate chỉ mở port 1 lần, các unit ID dùng lại cùng client
+    for baudrate, group in itertools.groupby(sorted(CONFIGS, key=lambda c: c.baudrate), key=lambda c: c.baudrate):
         # Test với timeout ngắn để nhanh
-        result = test_modbus_rtu_connection(
-            port=port,
-            baudrate=config['baudrate'],
-            unit_id=config['unit_id'],
-            timeout=0.5
-        )
-        
-        if result and result != False:
-            successful_configs.append(config)
-            print(f"✅ Configuration successful: {config}")
-        else:
-            print(f"❌ Configuration failed: {config}")
+        client = open_modbus_client(port, baudrate, timeout=0.5)
+        try:
+            for config in group:
+                log.info(f"\n--- Testing: Baudrate={config.baudrate}, Unit ID={config.unit_id} ---")
+                
+                result = False
+                if client is not None:
+                    result = test_modbus_rtu_connection(
+                        port=port,
+                        baudrate=config.baudrate,
+                        unit_id=config.unit_id,
+                        timeout=0.5,
+                        client=client
+                    )
+                
+                if result and result != False:
+                    successful_configs.append(config)
+                    log.info(f"✅ Configuration successful: {config}")
+                else:
+                    log.info(f"❌ Configuration failed: {config}")
+        finally:
+            if client is not None:
+                client.close()
+                log.info("🔌 Connection closed")
     
     return successful_configs
 
-def test_raw_serial_communication(port, baudrate=9600, timeout=2.0):
-    """Test raw serial communication để debug cấp thấp"""
-    print(f"\n=== Testing Raw Serial Communication ===")
-    print(f"Port: {port}, Baudrate: {baudrate}, Timeout: {timeout}s")
-    
+def decode_registers(buf):
+    """Giải mã các register uint16 big-endian trong 1 lần gọi struct.unpack (bỏ byte lẻ nếu có)"""
+    return struct.unpack(f'>{len(buf) // 2}H', buf[:len(buf) // 2 * 2])
+
+def read_exactly(ser, n, deadline, on_chunk=None, buf=None):
+    """Đọc thêm đúng n byte hoặc tới deadline (time.perf_counter), thoát ngay khi đủ byte.
+    Dữ liệu được nối (extend) vào bytearray buf (tạo mới nếu None) và trả về buf.
+    on_chunk(chunk) được gọi cho mỗi lần nhận dữ liệu (dùng để log debug)."""
+    if buf is None:
+        buf = bytearray()
+    end = len(buf) + n
     try:
-        import serial
-        
-        # Tạo kết nối serial
-        ser = serial.Serial(
-            port=port,
-            baudrate=baudrate,
-            bytesize=8,
-            parity='N',
-            stopbits=1,
-            timeout=timeout,
-            xonxoff=False,
-            rtscts=False,
-            dsrdtr=False
-        )
-        
-        print("✅ Raw serial connection established")
-        
-        # Test gửi Modbus RTU frame thô
-        # FC03 đọc 1 holding register tại địa chỉ 0, unit_id=1
-        # Frame: [unit_id][function_code][start_addr_hi][start_addr_lo][qty_hi][qty_lo][crc_lo][crc_hi]
-        test_frame = bytes([0x01, 0x03, 0x00, 0x00, 0x00, 0x01, 0x84, 0x0A])
-        
-        print(f"📤 Sending test frame: {test_frame.hex().upper()}")
-        
-        # Clear buffer
-        ser.reset_input_buffer()
-        ser.reset_output_buffer()
-        
-        # Gửi frame
-        start_time = time.time()
-        bytes_sent = ser.write(test_frame)
-        ser.flush()  # Đảm bảo data được gửi
-        
-        print(f"📤 Sent {bytes_sent} bytes")
+        fd = ser.fileno()  # POSIX: dùng select trên file descriptor
+    except (AttributeError, OSError):
+        fd = None  # Windows: serial handle không hỗ trợ select
+    
+    while len(buf) < end:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
         
-        # Đợi response
-        response_data = b''
-        response_timeout = 0.1  # Timeout cho mỗi byte
+        if fd is not None:
+            # Block trong kernel tới khi có dữ liệu hoặc hết thời gian, không sleep/poll
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                break
+            chunk = ser.read(min(ser.in_waiting, end - len(buf)) or 1)
+        else:
+            # Windows: ReadFile chờ event của driver (WaitForSingleObject) tới khi đủ byte/timeout
+            ser.timeout = remaining
+            chunk = ser.read(end - len(buf))
+            if not chunk:
+                break
         
-        while True:
-            if ser.in_waiting > 0:
-                chunk = ser.read(ser.in_waiting)
-                response_data += chunk
-                print(f"📥 Received chunk: {chunk.hex().upper()}")
+        buf += chunk
+        if on_chunk is not None:
+            on_chunk(chunk)
+    
+    return buf
+
+@contextlib.contextmanager
+def _open_serial(port, baudrate=9600, timeout=2.0):
+    """Mở serial handle 8N1 (không flow control) và tự đóng khi thoát"""
+    _set_low_latency(port)
+    ser = serial.Serial(
+        port=port,
+        baudrate=baudrate,
+        bytesize=8,
+        parity='N',
+        stopbits=1,
+        timeout=timeout,
+        xonxoff=False,
+        rtscts=False,
+        dsrdtr=False
+    )
+    try:
+        yield ser
+    finally:
+        try:
+            ser.close()
+            log.info("🔌 Raw serial connection closed")
+        except:
+            pass
+
+def test_raw_serial_communication(port, baudrate=9600, timeout=2.0, unit_id=1, ser=None):
+    """Test raw serial communication để debug cấp thấp (truyền ser để dùng lại handle đang mở)"""
+    log.info(f"\n=== Testing Raw Serial Communication ===")
+    log.info(f"Port: {port}, Baudrate: {baudrate}, Unit ID: {unit_id}, Timeout: {timeout}s")
+    
+    try:
+        with contextlib.ExitStack() as stack:
+            if ser is None:
+                # Tạo kết nối serial
+                ser = stack.enter_context(_open_serial(port, baudrate, timeout))
+                log.info("✅ Raw serial connection established")
             else:
-                # Kiểm tra timeout
-                elapsed = time.time() - start_time
-                if elapsed > timeout:
-                    break
-                time.sleep(response_timeout)
+                # Dùng lại handle: chỉ cấu hình lại baudrate/timeout
+                ser.baudrate = baudrate
+                ser.timeout = timeout
+                log.info("♻️ Reusing open serial handle")
+            
+            # Test gửi Modbus RTU frame thô
+            # FC03 đọc 1 holding register tại địa chỉ 0
+            test_frame = build_rtu_frame(unit_id, 0x03, 0, 1)
+        
+            log.info(f"📤 Sending test frame: {test_frame.hex().upper()}")
+        
+            # Clear buffer
+            ser.reset_input_buffer()
+            ser.reset_output_buffer()
+        
+            # Gửi frame
+            start = time.perf_counter_ns()
+            # Không flush(): read ngay sau đó chỉ trả về khi thiết bị đã nhận đủ frame và phản hồi
+            bytes_sent = ser.write(test_frame)
+        
+            log.info(f"📤 Sent {bytes_sent} bytes")
+        
+            # Đợi response: đọc header [unit][fc][byte_count] rồi đọc đúng phần còn lại
+            deadline = time.perf_counter() + timeout
+            log_chunk = lambda chunk: log.info("📥 Received chunk: %s", chunk.hex().upper())
+            response_data = bytearray()
+            read_exactly(ser, 3, deadline, log_chunk, response_data)
+            if len(response_data) == 3:
+                if response_data[1] & 0x80:
+                    # Exception response: [unit][fc|0x80][exception_code][crc_lo][crc_hi]
+                    tail_len = 2
+                else:
+                    tail_len = response_data[2] + 2
+                read_exactly(ser, tail_len, deadline, log_chunk, response_data)
         
-        total_time = (time.time() - start_time) * 1000
+            total_time = (time.perf_counter_ns() - start) / 1e6
         
-        if response_data:
-            print(f"📥 Total response: {response_data.hex().upper()} ({len(response_data)} bytes)")
-            print(f"⏱️ Response time: {total_time:.1f}ms")
+            if response_data:
+                log.info(f"📥 Total response: {response_data.hex().upper()} ({len(response_data)} bytes)")
+                log.info(f"⏱️ Response time: {total_time:.1f}ms")
             
-            # Phân tích response
-            if len(response_data) >= 5:
-                unit_id = response_data[0]
-                func_code = response_data[1]
-                byte_count = response_data[2]
+                # Phân tích response
+                if len(response_data) >= 5:
+                    unit_id = response_data[0]
+                    func_code = response_data[1]
+                    byte_count = response_data[2]
                 
-                print(f"📋 Response analysis:")
-                print(f"   Unit ID: {unit_id}")
-                print(f"   Function Code: {func_code}")
-                print(f"   Byte Count: {byte_count}")
+                    log.info(f"📋 Response analysis:")
+                    log.info(f"   Unit ID: {unit_id}")
+                    log.info(f"   Function Code: {func_code}")
+                    log.info(f"   Byte Count: {byte_count}")
                 
-                if len(response_data) >= byte_count + 5:
-                    data_bytes = response_data[3:3+byte_count]
-                    crc_bytes = response_data[3+byte_count:3+byte_count+2]
-                    print(f"   Data: {data_bytes.hex().upper()}")
-                    print(f"   CRC: {crc_bytes.hex().upper()}")
+                    if len(response_data) >= byte_count + 5:
+                        data_bytes = response_data[3:3+byte_count]
+                        crc_bytes = response_data[3+byte_count:3+byte_count+2]
+                        log.info(f"   Data: {data_bytes.hex().upper()}")
+                        log.info(f"   CRC: {crc_bytes.hex().upper()}")
                     
-                    if len(data_bytes) >= 2:
-                        value = (data_bytes[0] << 8) | data_bytes[1]
-                        print(f"   Register Value: {value}")
+                        values = decode_registers(data_bytes)
+                        if values:
+                            log.info(f"   Register Values: {', '.join(str(v) for v in values)}")
             
-            return {"success": True, "response": response_data.hex(), "latency_ms": total_time}
-        else:
-            print("❌ No response received")
-            return {"success": False, "error": "No response", "latency_ms": total_time}
+                return {"success": True, "response": response_data.hex(), "latency_ms": total_time}
+            else:
+                log.info("❌ No response received")
+                return {"success": False, "error": "No response", "latency_ms": total_time}
             
     except Exception as e:
-        print(f"❌ Raw serial test failed: {e}")
+        log.info(f"❌ Raw serial test failed: {e}")
         return {"success": False, "error": str(e)}
-    finally:
+
+# Cache baudrate hoạt động gần nhất theo port (giữa các lần chạy)
+_PROBE_CACHE_FILE = os.path.expanduser("~/.modbus_probe_cache.json")
+# test_all_ports chạy nhiều port song song -> đọc-sửa-ghi cache phải tuần tự
+_probe_cache_lock = threading.Lock()
+
+def _load_probe_cache():
+    """Đọc cache baudrate theo port (rỗng nếu chưa có/lỗi)"""
+    try:
+        with open(_PROBE_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_probe_cache(port, baudrate):
+    """Lưu baudrate hoạt động của port vào cache (ghi file tạm rồi os.replace)"""
+    with _probe_cache_lock:
+        cache = _load_probe_cache()
+        cache[port] = baudrate
+        tmp = f"{_PROBE_CACHE_FILE}.{os.getpid()}.tmp"
         try:
-            ser.close()
-            print("🔌 Raw serial connection closed")
-        except:
-            pass
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(cache, f)
+            os.replace(tmp, _PROBE_CACHE_FILE)
+        except OSError as e:
+            log.info(f"⚠️ Cannot save probe cache: {e}")
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
 
-def test_adaptive_baudrate_detection(port, unit_id=1):
-    """Tự động phát hiện baudrate phù hợp"""
-    print(f"\n=== Adaptive Baudrate Detection ===")
-    print(f"Port: {port}, Unit ID: {unit_id}")
+def test_adaptive_baudrate_detection(port, unit_id=1, first_hit=True):
+    """Tự động phát hiện baudrate phù hợp (first_hit=True: dừng ngay khi tìm thấy baudrate đầu tiên)"""
+    log.info(f"\n=== Adaptive Baudrate Detection ===")
+    log.info(f"Port: {port}, Unit ID: {unit_id}")
     
-    # Danh sách baudrate theo thứ tự phổ biến
+    # Danh sách baudrate theo thứ tự phổ biến, baudrate đã chạy được ở lần trước thử đầu tiên
     baudrates = [9600, 19200, 38400, 57600, 115200, 4800, 2400, 1200]
+    cached = _load_probe_cache().get(port)
+    if cached in baudrates:
+        baudrates.remove(cached)
+        baudrates.insert(0, cached)
+        log.info(f"💾 Last working baudrate for {port}: {cached}")
     successful_baudrates = []
     
-    for baudrate in baudrates:
-        print(f"\n--- Testing baudrate: {baudrate} ---")
-        
-        # Test với timeout ngắn
-        timeout = max(1.0, 10000 / baudrate)  # Timeout tự động
-        
-        # Test raw serial trước
-        raw_result = test_raw_serial_communication(port, baudrate, timeout)
+    pending = list(baudrates)
+    while pending:
+        # 1) Raw sweep: mở port 1 lần, chỉ đổi baudrate giữa các lần probe
+        raw_results = {}
+        try:
+            with _open_serial(port, pending[0]) as ser:
+                while pending:
+                    baudrate = pending.pop(0)
+                    log.info(f"\n--- Testing baudrate: {baudrate} ---")
+                    
+                    # Test với timeout ngắn
+                    timeout = max(1.0, 10000 / baudrate)  # Timeout tự động
+                    
+                    raw_result = test_raw_serial_communication(
+                        port, baudrate, timeout, unit_id=unit_id, ser=ser
+                    )
+                    raw_results[baudrate] = raw_result
+                    if first_hit and raw_result and raw_result.get('success'):
+                        break
+        except Exception as e:
+            log.info(f"❌ Cannot open port {port}: {e}")
+            return successful_baudrates
         
-        if raw_result and raw_result.get('success'):
-            print(f"✅ Raw serial successful at {baudrate}")
-            
-            # Test Modbus RTU
-            modbus_result = test_modbus_rtu_connection(
-                port=port,
-                baudrate=baudrate,
-                unit_id=unit_id,
-                timeout=timeout
-            )
+        # 2) Test Modbus RTU ở các baudrate mà raw serial có phản hồi
+        for baudrate, raw_result in raw_results.items():
+            timeout = max(1.0, 10000 / baudrate)
             
-            if modbus_result and modbus_result != False:
-                print(f"✅ Modbus RTU successful at {baudrate}")
-                successful_baudrates.append({
-                    "baudrate": baudrate,
-                    "raw_latency": raw_result.get('latency_ms', 0),
-                    "modbus_result": modbus_result
-                })
+            if raw_result and raw_result.get('success'):
+                log.info(f"✅ Raw serial successful at {baudrate}")
+                
+                # Test Modbus RTU
+                modbus_result = test_modbus_rtu_connection(
+                    port=port,
+                    baudrate=baudrate,
+                    unit_id=unit_id,
+                    timeout=timeout
+                )
+                
+                if modbus_result and modbus_result != False:
+                    log.info(f"✅ Modbus RTU successful at {baudrate}")
+                    successful_baudrates.append({
+                        "baudrate": baudrate,
+                        "raw_latency": raw_result.get('latency_ms', 0),
+                        "modbus_result": modbus_result
+                    })
+                    if first_hit:
+                        break
+                else:
+                    log.info(f"⚠️ Raw serial OK but Modbus failed at {baudrate}")
             else:
-                print(f"⚠️ Raw serial OK but Modbus failed at {baudrate}")
-        else:
-            print(f"❌ Raw serial failed at {baudrate}")
+                log.info(f"❌ Raw serial failed at {baudrate}")
+        
+        if first_hit and successful_baudrates:
+            break
+    
+    if successful_baudrates:
+        # Cache baudrate có latency thấp nhất, không phải baudrate thấy đầu tiên theo thứ tự quét
+        best = min(successful_baudrates, key=lambda r: r["raw_latency"])
+        _save_probe_cache(port, best["baudrate"])
     
     return successful_baudrates
 
 def test_comprehensive_rtu_debug(port):
     """Test debug RTU toàn diện"""
-    print(f"\n=== Comprehensive RTU Debug for {port} ===")
+    log.info(f"\n=== Comprehensive RTU Debug for {port} ===")
     
     results = {
         "port": port,
@@ -355,194 +709,207 @@ def test_comprehensive_rtu_debug(port):
     }
     
     # 1. Test cơ bản serial port
-    print("\n1️⃣ Basic Serial Port Test")
+    log.info("\n1️⃣ Basic Serial Port Test")
     results["basic_serial_test"] = test_serial_port_basic(port)
     
     if not results["basic_serial_test"]:
-        print("❌ Basic serial test failed. Aborting comprehensive test.")
+        log.info("❌ Basic serial test failed. Aborting comprehensive test.")
         return results
     
     # 2. Test adaptive baudrate detection  
-    print("\n2️⃣ Adaptive Baudrate Detection")
-    results["adaptive_baudrate"] = test_adaptive_baudrate_detection(port, unit_id=1)
+    log.info("\n2️⃣ Adaptive Baudrate Detection")
+    # Sắp xếp theo latency thực đo được -> phần tử đầu là baudrate tốt nhất
+    results["adaptive_baudrate"] = sorted(
+        test_adaptive_baudrate_detection(port, unit_id=1, first_hit=False),
+        key=lambda r: r["raw_latency"]
+    )
     
     # 3. Test raw communication với các baudrate phổ biến
-    print("\n3️⃣ Raw Communication Tests")
+    log.info("\n3️⃣ Raw Communication Tests")
     common_baudrates = [9600, 19200, 38400]
     
-    for baudrate in common_baudrates:
-        print(f"\n--- Raw test at {baudrate} ---")
-        results["raw_communication"][baudrate] = test_raw_serial_communication(port, baudrate)
+    try:
+        with _open_serial(port, common_baudrates[0]) as ser:
+            for baudrate in common_baudrates:
+                log.info(f"\n--- Raw test at {baudrate} ---")
+                results["raw_communication"][baudrate] = test_raw_serial_communication(port, baudrate, ser=ser)
+    except Exception as e:
+        log.info(f"❌ Cannot open port {port}: {e}")
     
     # 4. Test Modbus với multiple unit IDs nếu có baudrate thành công
-    print("\n4️⃣ Modbus Tests with Multiple Unit IDs")
+    log.info("\n4️⃣ Modbus Tests with Multiple Unit IDs")
     
     if results["adaptive_baudrate"]:
-        # Lấy baudrate tốt nhất
+        # Lấy baudrate tốt nhất (latency thấp nhất)
         best_baudrate = results["adaptive_baudrate"][0]["baudrate"] if results["adaptive_baudrate"] else 9600
         
-        print(f"Using best baudrate: {best_baudrate}")
+        log.info(f"Using best baudrate: {best_baudrate}")
         
-        for unit_id in [1, 2, 3, 247]:  # 247 là broadcast address
-            if unit_id == 247:
-                continue  # Skip broadcast cho read operations
-                
-            print(f"\n--- Testing Unit ID: {unit_id} ---")
-            modbus_result = test_modbus_rtu_connection(
-                port=port,
-                baudrate=best_baudrate,
-                unit_id=unit_id,
-                timeout=max(2.0, 15000 / best_baudrate)
-            )
-            results["modbus_tests"][f"unit_{unit_id}"] = modbus_result
+        # 247 là broadcast address -> bỏ qua cho read operations
+        unit_ids = [1, 2, 3]
+        results["modbus_tests"].update(test_modbus_rtu_units(
+            port,
+            best_baudrate,
+            unit_ids,
+            timeout=max(2.0, 15000 / best_baudrate)
+        ))
     
     # Summary
-    print(f"\n=== Debug Summary for {port} ===")
-    print(f"Basic Serial: {'✅' if results['basic_serial_test'] else '❌'}")
-    print(f"Working Baudrates: {len(results['adaptive_baudrate']) if results['adaptive_baudrate'] else 0}")
+    log.info(f"\n=== Debug Summary for {port} ===")
+    log.info(f"Basic Serial: {'✅' if results['basic_serial_test'] else '❌'}")
+    log.info(f"Working Baudrates: {len(results['adaptive_baudrate']) if results['adaptive_baudrate'] else 0}")
     
     working_raw = sum(1 for r in results['raw_communication'].values() if r and r.get('success'))
-    print(f"Raw Communication: {working_raw}/{len(results['raw_communication'])}")
+    log.info(f"Raw Communication: {working_raw}/{len(results['raw_communication'])}")
     
     working_modbus = sum(1 for r in results['modbus_tests'].values() if r and r != False)
-    print(f"Modbus Tests: {working_modbus}/{len(results['modbus_tests'])}")
+    log.info(f"Modbus Tests: {working_modbus}/{len(results['modbus_tests'])}")
     
     return results
 
+def test_all_ports(ports):
+    """Chạy comprehensive debug song song cho nhiều port (mỗi port 1 thread, log gom theo port)"""
+    ports = list(ports)
+    if not ports:
+        return {}
+    
+    output_lock = threading.Lock()
+    
+    def _run(port):
+        # Handler riêng của worker: chỉ nhận log của thread này, ghi vào buffer của port
+        ident = threading.get_ident()
+        buf = io.StringIO()
+        handler = logging.StreamHandler(buf)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        handler.addFilter(lambda record: record.thread == ident)
+        log.addHandler(handler)
+        _capturing_threads.add(ident)
+        try:
+            return test_comprehensive_rtu_debug(port)
+        finally:
+            _capturing_threads.discard(ident)
+            log.removeHandler(handler)
+            _close_thread_loop()
+            # In log của cả port 1 lần để không bị xen kẽ giữa các thread
+            with output_lock:
+                sys.stdout.write(buf.getvalue())
+                sys.stdout.flush()
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as ex:
+        return dict(zip(ports, ex.map(_run, ports)))
+
 def save_test_results(results, filename="rtu_test_results.txt"):
     """Lưu kết quả test ra file với format đẹp"""
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write("=== RTU Test Results ===\n")
-            f.write(f"Test time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("=" * 50 + "\n\n")
-            
-            def write_dict(data, indent=0):
-                """Recursive function để ghi dict với indentation"""
-                prefix = "  " * indent
-                
-                if isinstance(data, dict):
-                    for key, value in data.items():
-                        if isinstance(value, dict):
-                            f.write(f"{prefix}{key}:\n")
-                            write_dict(value, indent + 1)
-                        elif isinstance(value, list):
-                            f.write(f"{prefix}{key}: [\n")
-                            for i, item in enumerate(value):
-                                f.write(f"{prefix}  [{i}] ")
-                                if isinstance(item, dict):
-                                    f.write("\n")
-                                    write_dict(item, indent + 2)
-                                else:
-                                    f.write(f"{item}\n")
-                            f.write(f"{prefix}]\n")
-                        else:
-                            f.write(f"{prefix}{key}: {value}\n")
-                elif isinstance(data, list):
-                    for i, item in enumerate(data):
-                        f.write(f"{prefix}[{i}] {item}\n")
-                else:
-                    f.write(f"{prefix}{data}\n")
+        # Gom toàn bộ nội dung trong bộ nhớ rồi ghi file 1 lần
+        buf = io.StringIO()
+        buf.write("=== RTU Test Results ===\n")
+        buf.write(f"Test time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+        buf.write("=" * 50 + "\n\n")
+        
+        # Serialize toàn bộ kết quả 1 lần; default=str cho bytes/Exception lẫn trong kết quả
+        buf.write(json.dumps(results, indent=2, default=str, ensure_ascii=False))
+        buf.write("\n")
+        
+        # Thêm troubleshooting tips nếu có lỗi
+        if isinstance(results, dict):
+            has_errors = False
             
-            write_dict(results)
+            # Check for failures
+            for key, value in results.items():
+                if isinstance(value, dict):
+                    for subkey, subvalue in value.items():
+                        if (isinstance(subvalue, str) and "error" in subvalue.lower()) or \
+                           (isinstance(subvalue, dict) and subvalue.get('success') == False):
+                            has_errors = True
+                            break
+                elif value == False or (isinstance(value, str) and "error" in value.lower()):
+                    has_errors = True
+                    break
             
-            # Thêm troubleshooting tips nếu có lỗi
-            if isinstance(results, dict):
-                has_errors = False
-                
-                # Check for failures
-                for key, value in results.items():
-                    if isinstance(value, dict):
-                        for subkey, subvalue in value.items():
-                            if (isinstance(subvalue, str) and "error" in subvalue.lower()) or \
-                               (isinstance(subvalue, dict) and subvalue.get('success') == False):
-                                has_errors = True
-                                break
-                    elif value == False or (isinstance(value, str) and "error" in value.lower()):
-                        has_errors = True
-                        break
-                
-                if has_errors:
-                    f.write("\n" + "=" * 50 + "\n")
-                    f.write("TROUBLESHOOTING TIPS:\n")
-                    f.write("=" * 50 + "\n")
-                    f.write("1. Device Power: Ensure device is powered on and ready\n")
-                    f.write("2. Connections: Check A/B wire polarity and termination\n")
-                    f.write("3. Port Access: Close other programs using the COM port\n")
-                    f.write("4. Settings: Verify baudrate and unit ID match device config\n")
-                    f.write("5. Cable: Use proper RS485 cable with correct impedance\n")
-                    f.write("6. Distance: Long cables may need lower baudrates\n")
-                    f.write("7. Timeout: 9600 baud devices need timeout >= 3.0s\n")
-                    f.write("8. Unit ID: Try unit IDs 1, 2, 3 or check device manual\n")
-                    f.write("9. Function Codes: Some devices only support specific FCs\n")
-                    f.write("10. Grounding: Ensure proper electrical grounding\n")
-        
-        print(f"✅ Test results saved to {filename}")
+            if has_errors:
+                buf.write("\n" + "=" * 50 + "\n")
+                buf.write("TROUBLESHOOTING TIPS:\n")
+                buf.write("=" * 50 + "\n")
+                buf.write("1. Device Power: Ensure device is powered on and ready\n")
+                buf.write("2. Connections: Check A/B wire polarity and termination\n")
+                buf.write("3. Port Access: Close other programs using the COM port\n")
+                buf.write("4. Settings: Verify baudrate and unit ID match device config\n")
+                buf.write("5. Cable: Use proper RS485 cable with correct impedance\n")
+                buf.write("6. Distance: Long cables may need lower baudrates\n")
+                buf.write("7. Timeout: 9600 baud devices need timeout >= 3.0s\n")
+                buf.write("8. Unit ID: Try unit IDs 1, 2, 3 or check device manual\n")
+                buf.write("9. Function Codes: Some devices only support specific FCs\n")
+                buf.write("10. Grounding: Ensure proper electrical grounding\n")
+        
+        pathlib.Path(filename).write_text(buf.getvalue(), encoding='utf-8')
+        log.info(f"✅ Test results saved to {filename}")
         return True
         
     except Exception as e:
-        print(f"❌ Failed to save results: {e}")
+        log.info(f"❌ Failed to save results: {e}")
         return False
 
 def interactive_test():
     """Test tương tác với người dùng được cải thiện"""
-    print("=== Enhanced Interactive RTU Tester ===")
-    print("🔧 This tool helps debug RTU communication issues, especially for 9600 baud devices")
+    log.info("=== Enhanced Interactive RTU Tester ===")
+    log.info("🔧 This tool helps debug RTU communication issues, especially for 9600 baud devices")
     
     # Liệt kê ports
     available_ports = list_available_ports()
     if not available_ports:
-        print("❌ No COM ports available for testing")
+        log.info("❌ No COM ports available for testing")
         return
     
     # Chọn port
-    print(f"\nAvailable ports: {', '.join(available_ports)}")
+    log.info(f"\nAvailable ports: {', '.join(available_ports)}")
     while True:
         port = input(f"Enter COM port to test (e.g. COM3): ").strip().upper()
         if port in available_ports or port.startswith('COM'):
             break
-        print(f"❌ Invalid port. Please choose from: {', '.join(available_ports)}")
+        log.info(f"❌ Invalid port. Please choose from: {', '.join(available_ports)}")
     
     # Chọn test mode
-    print(f"\n🔧 Test Options:")
-    print("1. Quick Test (9600 baud, unit ID 1)")
-    print("2. Comprehensive Debug (all baudrates, raw + Modbus)")
-    print("3. Adaptive Baudrate Detection")
-    print("4. Raw Serial Communication Test")
-    print("5. Multiple Configuration Test")
+    log.info(f"\n🔧 Test Options:")
+    log.info("1. Quick Test (9600 baud, unit ID 1)")
+    log.info("2. Comprehensive Debug (all baudrates, raw + Modbus)")
+    log.info("3. Adaptive Baudrate Detection")
+    log.info("4. Raw Serial Communication Test")
+    log.info("5. Multiple Configuration Test")
+    log.info("6. Comprehensive Debug on ALL ports (parallel)")
     
     while True:
         try:
-            choice = int(input("\nSelect test mode (1-5): ").strip())
-            if 1 <= choice <= 5:
+            choice = int(input("\nSelect test mode (1-6): ").strip())
+            if 1 <= choice <= 6:
                 break
         except ValueError:
             pass
-        print("❌ Please enter a number between 1-5")
+        log.info("❌ Please enter a number between 1-6")
     
     # Execute based on choice
     if choice == 1:
         # Quick Test
-        print(f"\n🚀 Running Quick Test on {port}...")
+        log.info(f"\n🚀 Running Quick Test on {port}...")
         
         if not test_serial_port_basic(port):
-            print("❌ Basic serial port test failed. Check if port is not in use.")
+            log.info("❌ Basic serial port test failed. Check if port is not in use.")
             return
         
         result = test_modbus_rtu_connection(port, baudrate=9600, unit_id=1)
         
         if result and result != False:
-            print("\n✅ Quick test successful! Device responds at 9600 baud, unit ID 1")
+            log.info("\n✅ Quick test successful! Device responds at 9600 baud, unit ID 1")
             save_choice = input("Save results to file? (y/n): ").strip().lower()
             if save_choice == 'y':
                 save_test_results({"quick_test": result}, f"quick_test_{port.lower()}.txt")
         else:
-            print("\n❌ Quick test failed. Consider running comprehensive debug.")
+            log.info("\n❌ Quick test failed. Consider running comprehensive debug.")
     
     elif choice == 2:
         # Comprehensive Debug
-        print(f"\n🔍 Running Comprehensive Debug on {port}...")
-        print("⚠️ This may take several minutes...")
+        log.info(f"\n🔍 Running Comprehensive Debug on {port}...")
+        log.info("⚠️ This may take several minutes...")
         
         results = test_comprehensive_rtu_debug(port)
         
@@ -551,44 +918,45 @@ def interactive_test():
         save_test_results(results, filename)
         
         # Recommendations
-        print(f"\n💡 Recommendations based on test results:")
+        log.info(f"\n💡 Recommendations based on test results:")
         
         if results.get("adaptive_baudrate"):
             best_config = results["adaptive_baudrate"][0]
-            print(f"✅ Best configuration found:")
-            print(f"   - Baudrate: {best_config['baudrate']}")
-            print(f"   - Latency: {best_config['raw_latency']:.1f}ms")
+            log.info(f"✅ Best configuration found:")
+            log.info(f"   - Baudrate: {best_config['baudrate']}")
+            log.info(f"   - Latency: {best_config['raw_latency']:.1f}ms")
             
             if best_config['baudrate'] == 9600:
-                print(f"⚠️ Device uses 9600 baud - ensure timeout >= 3.0s in production")
+                log.info(f"⚠️ Device uses 9600 baud - ensure timeout >= 3.0s in production")
             
         else:
-            print(f"❌ No working configuration found. Check:")
-            print(f"   - Device power and connections")
-            print(f"   - Cable wiring (A/B polarity)")
-            print(f"   - Device unit ID settings")
-            print(f"   - Port availability (close other programs)")
+            log.info(f"❌ No working configuration found. Check:")
+            log.info(f"   - Device power and connections")
+            log.info(f"   - Cable wiring (A/B polarity)")
+            log.info(f"   - Device unit ID settings")
+            log.info(f"   - Port availability (close other programs)")
     
     elif choice == 3:
         # Adaptive Baudrate Detection
-        print(f"\n🔍 Running Adaptive Baudrate Detection on {port}...")
+        log.info(f"\n🔍 Running Adaptive Baudrate Detection on {port}...")
         
         if not test_serial_port_basic(port):
-            print("❌ Basic serial port test failed.")
+            log.info("❌ Basic serial port test failed.")
             return
             
-        results = test_adaptive_baudrate_detection(port, unit_id=1)
+        # Mặc định dừng ở baudrate đầu tiên chạy được; chạy với --all để quét toàn bộ
+        results = test_adaptive_baudrate_detection(port, unit_id=1, first_hit='--all' not in sys.argv)
         
         if results:
-            print(f"\n✅ Found {len(results)} working baudrate(s):")
+            log.info(f"\n✅ Found {len(results)} working baudrate(s):")
             for result in results:
-                print(f"   - {result['baudrate']} baud (latency: {result['raw_latency']:.1f}ms)")
+                log.info(f"   - {result['baudrate']} baud (latency: {result['raw_latency']:.1f}ms)")
         else:
-            print(f"\n❌ No working baudrates found")
+            log.info(f"\n❌ No working baudrates found")
     
     elif choice == 4:
         # Raw Serial Test
-        print(f"\n� Running Raw Serial Communication Test on {port}...")
+        log.info(f"\n� Running Raw Serial Communication Test on {port}...")
         
         baudrate = 9600
         try:
@@ -596,40 +964,52 @@ def interactive_test():
             if custom_baud:
                 baudrate = int(custom_baud)
         except ValueError:
-            print("Using default baudrate 9600")
+            log.info("Using default baudrate 9600")
         
         result = test_raw_serial_communication(port, baudrate)
         
         if result and result.get('success'):
-            print(f"\n✅ Raw communication successful")
+            log.info(f"\n✅ Raw communication successful")
         else:
-            print(f"\n❌ Raw communication failed")
+            log.info(f"\n❌ Raw communication failed")
     
     elif choice == 5:
         # Multiple Configuration Test
-        print(f"\n🔄 Running Multiple Configuration Test on {port}...")
+        log.info(f"\n🔄 Running Multiple Configuration Test on {port}...")
         
         if not test_serial_port_basic(port):
-            print("❌ Basic serial port test failed.")
+            log.info("❌ Basic serial port test failed.")
             return
             
         successful_configs = test_multiple_configurations(port)
         
         if successful_configs:
-            print(f"\n✅ Found {len(successful_configs)} working configurations:")
+            log.info(f"\n✅ Found {len(successful_configs)} working configurations:")
             for config in successful_configs:
-                print(f"   - Baudrate: {config['baudrate']}, Unit ID: {config['unit_id']}")
+                log.info(f"   - Baudrate: {config.baudrate}, Unit ID: {config.unit_id}")
         else:
-            print(f"\n❌ No working configurations found")
+            log.info(f"\n❌ No working configurations found")
+    
+    elif choice == 6:
+        # Comprehensive Debug song song cho tất cả port
+        log.info(f"\n🔍 Running Comprehensive Debug on {', '.join(available_ports)}...")
+        log.info("⚠️ This may take several minutes...")
+        
+        all_results = test_all_ports(available_ports)
+        
+        for p, results in all_results.items():
+            filename = f"comprehensive_debug_{os.path.basename(p).lower()}_{int(time.time())}.txt"
+            save_test_results(results, filename)
     
-    print(f"\n🏁 Test completed for {port}")
+    log.info(f"\n🏁 Test completed for {port}")
 
 if __name__ == "__main__":
+    _setup_logging()
     try:
         interactive_test()
     except KeyboardInterrupt:
-        print("\n\n❌ Test interrupted by user")
+        log.info("\n\n❌ Test interrupted by user")
     except Exception as e:
-        print(f"\n❌ Unexpected error: {e}")
+        log.info(f"\n❌ Unexpected error: {e}")
     
     input("\nPress Enter to exit...")
\ No newline at end of file
@@ -1,11 +1,18 @@
-# thread_modbus_50.py  -- Python 3.13, threads + barrier + scheduler
-import math, time, threading
+# async_modbus_50.py  -- Python 3.13, asyncio tasks + scheduler
+# Chạy:
+#   python asyn_mobbus.py
+#   gunicorn -w 1 --threads 100 -b 0.0.0.0:5000 "asyn_mobbus:create_app()"
+import asyncio, heapq, math, sys, threading, time
+from array import array
 from dataclasses import dataclass
-from typing import List
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import List, Tuple
 from flask import Flask, render_template_string
-from flask_socketio import SocketIO
-from pymodbus.client import ModbusTcpClient
-from pymodbus.exceptions import ModbusException
+from flask_socketio import SocketIO, join_room
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusException
+from sio_json import SIO_JSON
 
 # ===================== CẤU HÌNH =====================
 GATEWAY_HOST = "127.0.0.1"
@@ -15,6 +22,17 @@ INTERVAL_SEC  = 1      # chu kỳ đọc mỗi thiết bị (ví dụ 0.2s nếu
 TIMEOUT_SEC   = 0.5      # timeout mỗi lần đọc (đặt < INTERVAL_SEC)
 READ_COUNT    = 6        # số thanh ghi đọc mỗi lần (giảm để nhanh hơn)
 
+# Gộp các vùng thanh ghi cùng slave thành 1 request FC03
+MAX_READ_REGS = 125      # giới hạn thanh ghi / 1 request FC03
+MERGE_GAP     = 8        # gộp 2 vùng nếu cách nhau <= MERGE_GAP thanh ghi
+
+# Hạn chế song song theo host (để 1 nếu là TCP->RS485 gateway)
+PER_HOST_LIMIT = 1
+
+# Queue & batch emit
+QUEUE_MAX     = 10_000   # hàng đợi ra UI
+BATCH_EMIT_MS = 8        # gom gói trong ~8ms rồi emit 1 lần
+
 # Nếu bạn muốn CHẠY BÙ (không bỏ tick): đặt True (có thể dồn đọc nếu bị trễ)
 # Nếu False: sẽ bắt nhịp bằng cách nhảy qua tick trễ (nhanh nhưng có thể "nhảy số")
 DRAIN_BACKLOG = False
@@ -26,6 +44,17 @@ class Device:
     device_id: int
     interval: float
     timeout: float
+    address: int = 0
+    count: int = READ_COUNT
+
+@dataclass
+class ReadBlock:
+    """1 request FC03 (slave, start, count) phục vụ nhiều thiết bị logic."""
+    slave: int
+    start: int
+    count: int
+    interval: float
+    members: List[Tuple[Device, int]]   # (thiết bị, offset trong block)
 
 DEVICES: List[Device] = [
     Device(id=f"dev{u}", device_id=u, interval=INTERVAL_SEC, timeout=TIMEOUT_SEC)
@@ -35,7 +64,7 @@ DEVICES: List[Device] = [
 # ===================== WEB + SOCKET.IO =====================
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "secret!"
-socketio = SocketIO(app, async_mode="threading", cors_allowed_origins="*")
+socketio = SocketIO(app, async_mode="threading", cors_allowed_origins="*", json=SIO_JSON)
 
 INDEX_HTML = """<!doctype html>
 <html>
@@ -65,30 +94,26 @@ INDEX_HTML = """<!doctype html>
 </head>
 <body>
   <div class="wrap">
-    <h1>Modbus Live Dashboard — 30 units on {{host}}:{{port}}</h1>
+    <h1>Modbus Live Dashboard — {{devices|length}} units on {{host}}:{{port}}</h1>
     <div class="grid" id="cards">
-      <script>
-        for (let u = 1; u <= 30; u++) {
-          document.write(`
-            <div class="card" id="card-dev${u}">
-              <div class="title">
-                <span>dev${u}</span>
-                <span class="pill" id="pill-dev${u}">waiting…</span>
-              </div>
-              <div class="meta">
-                <div>device_id: <b>${u}</b></div>
-                <div>latency: <b id="lat-dev${u}">—</b> ms</div>
-                <div>updated: <span class="ts" id="ts-dev${u}">—</span></div>
-                <div>seq: <b id="seq-dev${u}">—</b></div>
-              </div>
-              <div class="regs mono" id="regs-dev${u}">
-                <span class="muted">[no data]</span>
-              </div>
-              <div class="spark" id="spark-dev${u}"></div>
-            </div>
-          `);
-        }
-      </script>
+      {% for d in devices %}
+      <div class="card" id="card-{{d.id}}">
+        <div class="title">
+          <span>{{d.id}}</span>
+          <span class="pill" id="pill-{{d.id}}">waiting…</span>
+        </div>
+        <div class="meta">
+          <div>device_id: <b>{{d.device_id}}</b></div>
+          <div>latency: <b id="lat-{{d.id}}">—</b> ms</div>
+          <div>updated: <span class="ts" id="ts-{{d.id}}">—</span></div>
+          <div>seq: <b id="seq-{{d.id}}">—</b></div>
+        </div>
+        <div class="regs mono" id="regs-{{d.id}}">
+          <span class="muted">[no data]</span>
+        </div>
+        <div class="spark" id="spark-{{d.id}}"></div>
+      </div>
+      {% endfor %}
     </div>
   </div>
 
@@ -114,7 +139,14 @@ INDEX_HTML = """<!doctype html>
       else { el.textContent = "waiting…"; }
     }
     socket.on("connect", () => console.log("connected"));
-    socket.on("modbus_update", (msg) => {
+    // data = bytes uint16 little-endian (Socket.IO binary attachment -> ArrayBuffer)
+    function regsText(buf) {
+      const dv = new DataView(buf);
+      const vals = new Array(buf.byteLength >> 1);
+      for (let i = 0; i < vals.length; i++) vals[i] = dv.getUint16(i * 2, true);
+      return vals.join(", ");
+    }
+    function applyOne(msg) {
       const id = msg.device_id;
       const regsEl = document.getElementById(`regs-${id}`);
       const tsEl = document.getElementById(`ts-${id}`);
@@ -122,7 +154,7 @@ INDEX_HTML = """<!doctype html>
       const seqEl = document.getElementById(`seq-${id}`);
       if (msg.ok) {
         setPill(id, true);
-        if (Array.isArray(msg.data) && msg.data.length) regsEl.textContent = msg.data.join(", ");
+        if (msg.data && msg.data.byteLength) regsEl.textContent = regsText(msg.data);
         else regsEl.textContent = "[empty]";
       } else {
         setPill(id, false, "ERR");
@@ -132,120 +164,295 @@ INDEX_HTML = """<!doctype html>
       if (typeof msg.ts === "number") tsEl.textContent = fmtTs(msg.ts);
       if (typeof msg.seq === "number") seqEl.textContent = msg.seq;
       pulse(id);
-    });
+    }
+    socket.on("modbus_update", applyOne);
+    socket.on("modbus_batch", arr => arr.forEach(applyOne));
   </script>
 </body>
 </html>
 """
 
+# Trang tĩnh (host/port/danh sách thiết bị cố định) -> render 1 lần rồi dùng lại
+_index_page: str | None = None
+
 @app.route("/")
 def index():
-    return render_template_string(INDEX_HTML, host=GATEWAY_HOST, port=GATEWAY_PORT)
+    global _index_page
+    if _index_page is None:
+        _index_page = render_template_string(
+            INDEX_HTML, host=GATEWAY_HOST, port=GATEWAY_PORT, devices=DEVICES
+        )
+    return _index_page
+
+# Mọi dashboard vào chung 1 room -> mỗi lần emit chỉ encode payload 1 lần rồi fan-out
+DASHBOARD_ROOM = "dashboard"
+
+@socketio.on("connect")
+def on_connect():
+    join_room(DASHBOARD_ROOM)
+
+# ===================== POOL 1 KẾT NỐI / HOST =====================
+class HostPool:
+    """
+    Giữ 1 AsyncModbusTcpClient dùng lại + hàng đợi request cho pipeline:
+    per_host_limit coroutine pipeline() là nơi duy nhất gửi request tới gateway.
+    """
+    def __init__(self, host: str, port: int, per_host_limit: int, timeout: float):
+        self.host, self.port, self.timeout = host, port, timeout
+        self.per_host_limit = per_host_limit
+        self.requests: asyncio.Queue = asyncio.Queue()   # (block, future)
+        self._client: AsyncModbusTcpClient | None = None
+        self._lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def session(self):
+        async with self._lock:
+            if self._client is None:
+                self._client = AsyncModbusTcpClient(host=self.host, port=self.port, timeout=self.timeout)
+                ok = await self._client.connect()
+                if not ok:
+                    self._client = None
+                    raise ConnectionError(f"connect_fail {self.host}:{self.port}")
+        try:
+            yield self._client
+        except Exception as e:
+            # timeout / exception response của 1 unit: kết nối vẫn dùng được cho block khác;
+            # chỉ bỏ client (lần sau connect lại) khi lỗi kết nối thật
+            if isinstance(e, (asyncio.TimeoutError, ModbusException)) and not isinstance(e, ConnectionException):
+                raise
+            try: self._client.close()
+            except: pass
+            self._client = None
+            raise
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+# ===================== KẾ HOẠCH ĐỌC (gộp vùng thanh ghi) =====================
+def plan_reads(devices: List[Device]) -> List[ReadBlock]:
+    """
+    Gom (slave, address, count) theo slave, sắp theo address và gộp các vùng
+    chồng lấn/kề nhau (cách <= MERGE_GAP) thành 1 block tối đa MAX_READ_REGS.
+    """
+    by_slave = defaultdict(list)
+    for dev in devices:
+        by_slave[dev.device_id].append(dev)
+
+    blocks: List[ReadBlock] = []
+    for slave, devs in sorted(by_slave.items()):
+        devs.sort(key=lambda d: d.address)
+        cur = None
+        for dev in devs:
+            end = dev.address + dev.count
+            if (cur is not None
+                    and dev.address <= cur.start + cur.count + MERGE_GAP
+                    and end - cur.start <= MAX_READ_REGS):
+                cur.count = max(cur.count, end - cur.start)
+                cur.interval = min(cur.interval, dev.interval)
+                cur.members.append((dev, dev.address - cur.start))
+            else:
+                cur = ReadBlock(slave, dev.address, dev.count, dev.interval, [(dev, 0)])
+                blocks.append(cur)
+    return blocks
+
+# ===================== HÀNG ĐỢI + BROADCASTER =====================
+# reader (event loop) append -> 1 thread worker_emit gọi socketio.emit.
+# deque(maxlen) tự bỏ phần tử cũ nhất khi đầy (trong C, không cần bắt QueueFull).
+emit_dq: deque = deque(maxlen=QUEUE_MAX)
+emit_have = threading.Event()
+
+def new_payload(dev: Device) -> dict:
+    """Payload dùng lại cho 1 thiết bị: chỉ các field thay đổi được ghi đè mỗi tick."""
+    return {
+        "device_id": dev.id,
+        "unit": dev.device_id,
+        "ok": False,
+        "data": None,
+        "error": None,
+        "seq": 0,
+        "latency_ms": 0,
+        "ts": 0.0,
+    }
 
-# ===================== WORKER (1 thread / device) =====================
-def reader(dev: Device, start_epoch: float, barrier: threading.Barrier):
+def emit_block(payloads, ok, regs, err, seq, latency_ms, ts):
     """
-    - Đồng bộ xuất phát bằng Barrier.
-    - Lịch chống trôi theo mốc chung (start_epoch).
+    Cắt dữ liệu block về từng thiết bị logic (payloads = [(offset, count, payload)]),
+    regs là array('H') -> data gửi dạng bytes (binary frame, 2 byte/thanh ghi),
+    cập nhật payload tại chỗ và đẩy bản sao vào hàng đợi emit (thread emit
+    serialize song song với event loop nên không được giữ dict đang dùng lại).
+    """
+    append = emit_dq.append
+    for offs, count, payload in payloads:
+        if not ok:
+            data = None
+        elif offs == 0 and count == len(regs):
+            data = regs.tobytes()
+        else:
+            data = regs[offs:offs + count].tobytes()
+        payload["ok"] = ok
+        payload["data"] = data
+        payload["error"] = err
+        payload["seq"] = seq
+        payload["latency_ms"] = latency_ms
+        payload["ts"] = ts
+        append(dict(payload))
+    emit_have.set()
+
+def worker_emit():
+    """
+    Consumer duy nhất (1 thread): gom các update trong ~BATCH_EMIT_MS rồi emit
+    1 frame "modbus_batch". Mỗi phần tử là bản sao riêng của 1 lần đọc nên gửi
+    đủ cả (kể cả các lần chạy bù của DRAIN_BACKLOG).
+    """
+    while True:
+        emit_have.wait()
+        time.sleep(BATCH_EMIT_MS / 1000.0)
+        # clear trước khi lấy: update đến sau đó sẽ set lại cờ cho vòng sau
+        emit_have.clear()
+        batch = [emit_dq.popleft() for _ in range(len(emit_dq))]
+        if not batch:
+            continue
+        socketio.emit("modbus_batch", batch, to=DASHBOARD_ROOM, namespace="/")
+
+# ===================== POLLER (1 event loop, 1 scheduler) =====================
+async def pipeline(pool: HostPool):
+    """
+    Gửi lần lượt các request trong pool.requests qua kết nối chung: gateway
+    TCP->RS485 chỉ phục vụ 1 request/lúc nên xếp hàng phía mình thay vì dồn ở gateway.
+    Kết quả (ok, registers, error) trả về qua future của người gửi.
+    """
+    requests = pool.requests
+    while True:
+        block, fut = await requests.get()
+        if fut.done():      # người gửi đã huỷ
+            continue
+        try:
+            async with pool.session() as client:
+                # timeout phía asyncio: request treo không chặn hàng đợi quá TIMEOUT_SEC
+                async with asyncio.timeout(pool.timeout):
+                    rr = await client.read_holding_registers(
+                        block.start, count=block.count, slave=block.slave
+                    )
+            if rr.isError():
+                res = (False, None, str(rr))
+            else:
+                regs = array("H", rr.registers)
+                if sys.byteorder == "big":
+                    regs.byteswap()     # frontend đọc little-endian
+                res = (True, regs, None)
+        except Exception as e:
+            res = (False, None, repr(e))
+        if not fut.done():
+            fut.set_result(res)
+
+async def read_block(block: ReadBlock, pool: HostPool):
+    """Gửi 1 request FC03 cho cả block vào pipeline -> (ok, registers, error)."""
+    fut = asyncio.get_running_loop().create_future()
+    pool.requests.put_nowait((block, fut))
+    return await fut
+
+@dataclass
+class BlockState:
+    """Trạng thái chạy của 1 block trong scheduler."""
+    block: ReadBlock
+    payloads: list            # [(offset, count, payload)] dùng lại mỗi tick
+    seq: int = 0
+    pending: int = 0          # số tick chờ đọc (DRAIN_BACKLOG) hoặc 0/1 (bỏ tick trễ)
+    busy: bool = False        # đang có task đọc block này
+
+async def scheduler(blocks: List[ReadBlock], pool: HostPool, start_epoch: float):
+    """
+    1 coroutine lập lịch cho mọi block bằng min-heap (next_run, idx):
+    - Lấy block đến hạn sớm nhất, đẩy lại mốc kế tiếp (O(log N)), rồi tạo task đọc;
+      request đi qua pipeline() nên số request đang bay = PER_HOST_LIMIT.
+    - Lịch chống trôi theo mốc chung (start_epoch, theo loop.time()).
     - Bắt nhịp: bỏ tick trễ (mặc định) hoặc chạy bù (nếu DRAIN_BACKLOG=True).
+    - 1 đồng hồ duy nhất (loop.time, monotonic): ts = mốc wall + monotonic.
+    """
+    loop = asyncio.get_running_loop()
+    mono = loop.time
+    wall_anchor = time.time() - mono()
+    # Hàm/hằng dùng mỗi tick -> biến local (tránh LOAD_GLOBAL/LOAD_ATTR lặp lại)
+    sleep, create_task = asyncio.sleep, loop.create_task
+    heapreplace = heapq.heapreplace
+    read, emit = read_block, emit_block
+    drain = DRAIN_BACKLOG
+
+    states = [BlockState(b, [(offs, dev.count, new_payload(dev)) for dev, offs in b.members])
+              for b in blocks]
+    heap = [(start_epoch, i) for i in range(len(states))]
+    heapq.heapify(heap)
+    running = set()   # giữ tham chiếu task đọc (tránh bị GC giữa chừng)
+
+    async def run_block(st: BlockState):
+        """Đọc + emit cho tới khi hết tick đang chờ của block."""
+        try:
+            while st.pending:
+                st.pending -= 1
+                t0 = mono()
+                ok, data, err = await read(st.block, pool)
+                st.seq += 1
+                now = mono()
+                emit(st.payloads, ok, data, err, st.seq,
+                           int((now - t0) * 1000), wall_anchor + now)
+        finally:
+            st.busy = False
+
+    while heap:
+        next_run, i = heap[0]
+        now = mono()
+        if now < next_run:
+            await sleep(next_run - now)
+            now = mono()
+
+        st = states[i]
+        itv = st.block.interval
+        if drain:
+            # chạy bù: mỗi mốc đã trễ đều được đọc
+            st.pending += 1
+            next_run += itv
+        else:
+            # bỏ qua các mốc đã trễ để bắt nhịp nhanh (O(1), không lặp từng mốc)
+            st.pending = 1
+            next_run += (max(0, int((now - next_run) // itv)) + 1) * itv
+        heapreplace(heap, (next_run, i))
+
+        if not st.busy:
+            st.busy = True
+            task = create_task(run_block(st))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+async def poller_main():
+    """
+    1 HostPool (1 kết nối tới gateway) + PER_HOST_LIMIT pipeline gửi request
+    + 1 scheduler cho mọi block đọc trong cùng event loop.
     """
-    client = ModbusTcpClient(host=GATEWAY_HOST, port=GATEWAY_PORT, timeout=dev.timeout)
-    client.connect()
+    socketio.start_background_task(worker_emit)
+    pool = HostPool(GATEWAY_HOST, GATEWAY_PORT, PER_HOST_LIMIT, TIMEOUT_SEC)
     try:
-        # 1) Đợi tất cả thread sẵn sàng
-        barrier.wait()
-
-        # 2) Chờ tới mốc xuất phát chung
-        now = time.monotonic()
-        if now < start_epoch:
-            barrier.wait(timeout=start_epoch - now)
-
-        next_run = start_epoch
-        seq = 0
-        while True:
-            now = time.monotonic()
-            if now < next_run:
-                time.sleep(next_run - now)
-
-            t0 = time.perf_counter()
-            ok, data, err = False, None, None
-            try:
-                # API theo bạn cung cấp: device_id=
-                rr = client.read_holding_registers(
-                    0, count=READ_COUNT, slave              =dev.device_id
-                )
-                if rr.isError():
-                    err = str(rr)
-                else:
-                    ok = True
-                    data = rr.registers
-            except Exception as e:
-                err = repr(e)
-
-            seq += 1
-            socketio.emit("modbus_update", {
-                "device_id": dev.id,
-                "unit": dev.device_id,
-                "ok": ok,
-                "data": data,
-                "error": err,
-                "seq": seq,
-                "latency_ms": int((time.perf_counter() - t0) * 1000),
-                "ts": time.time(),
-            }, namespace="/")
-
-            # 3) Lên lịch tick tiếp theo
-            next_run += dev.interval
-
-            # 4) Bắt kịp lịch
-            if DRAIN_BACKLOG:
-                # chạy bù (có thể dồn khi thiết bị chậm)
-                while time.monotonic() >= next_run:
-                    # chạy ngay một vòng "bù"
-                    t0 = time.perf_counter()
-                    ok, data, err = False, None, None
-                    try:
-                        rr = client.read_holding_registers(
-                            0, count=READ_COUNT, device_id=dev.device_id
-                        )
-                        if rr.isError():
-                            err = str(rr)
-                        else:
-                            ok = True
-                            data = rr.registers
-                    except Exception as e:
-                        err = repr(e)
-
-                    seq += 1
-                    socketio.emit("modbus_update", {
-                        "device_id": dev.id,
-                        "unit": dev.device_id,
-                        "ok": ok,
-                        "data": data,
-                        "error": err,
-                        "seq": seq,
-                        "latency_ms": int((time.perf_counter() - t0) * 1000),
-                        "ts": time.time(),
-                    }, namespace="/")
-
-                    next_run += dev.interval
-            else:
-                # bỏ qua các mốc đã trễ để bắt nhịp nhanh
-                while time.monotonic() >= next_run:
-                    next_run += dev.interval
+        # Mốc xuất phát chung (giây kế tiếp)
+        start_epoch = math.ceil(asyncio.get_running_loop().time()) + 1
+        tasks = [asyncio.create_task(pipeline(pool)) for _ in range(pool.per_host_limit)]
+        tasks.append(asyncio.create_task(scheduler(plan_reads(DEVICES), pool, start_epoch)))
+        await asyncio.gather(*tasks)
     finally:
-        try: client.close()
-        except: pass
+        pool.close()
 
 def start_poller():
-    # Mốc xuất phát chung (giây kế tiếp) + Barrier cho 50 thiết bị
-    start_epoch = math.ceil(time.monotonic()) + 1
-    barrier = threading.Barrier(len(DEVICES))
-    for dev in DEVICES:
-        threading.Thread(target=reader, args=(dev, start_epoch, barrier), daemon=True).start()
+    # Event loop của poller chạy trong 1 background task của Socket.IO (1 thread duy nhất)
+    socketio.start_background_task(asyncio.run, poller_main())
+
+def create_app():
+    """Entry point cho gunicorn: khởi động poller rồi trả về app."""
+    start_poller()
+    return app
 
 # ===================== MAIN =====================
 if __name__ == "__main__":
     start_poller()
     # Lưu ý: với nhiều thread + SocketIO, để production hãy cân nhắc Redis message_queue
-    socketio.run(app, host="0.0.0.0", port=5000, debug=True)
+    # debug=False: không bật reloader/debugger của Werkzeug (fork thêm 1 process)
+    socketio.run(app, host="0.0.0.0", port=5000)
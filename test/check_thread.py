@@ -18,6 +18,7 @@ from starlette.applications import Starlette
 from starlette.responses import HTMLResponse
 from starlette.routing import Route
 from uvicorn import run as uvicorn_run
+from sio_json import SIO_JSON
 
 # ================== CẤU HÌNH ==================
 HOST, PORT = "127.0.0.1", 502
@@ -53,7 +54,7 @@ class Dev:
 ALL_DEVS: List[Dev] = [Dev(f"dev{u}", u, INTERVAL, TIMEOUT) for u in range(1, NUM_DEVICES+1)]
 
 # ================== WEB / SOCKET ==================
-sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
+sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*", json=SIO_JSON)
 
 HTML = """<!doctype html>
 <meta charset="utf-8"><title>Hybrid Modbus (flags)</title>
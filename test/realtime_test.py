@@ -1,8 +1,16 @@
 # app.py
+# Chạy:
+#   python realtime_test.py
+#   gunicorn -k eventlet -w 1 -b 0.0.0.0:5000 "realtime_test:create_app()"
+# eventlet phải monkey_patch trước mọi import khác: thread/socket/sleep -> green
+import eventlet
+eventlet.monkey_patch()
+
 import math, time, threading
 from flask import Flask, render_template
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room
 from pymodbus.client import ModbusTcpClient
+from sio_json import SIO_JSON
 
 # ==== CẤU HÌNH (cùng IP, khác unit_id) ====
 GATEWAY = {"host": "127.0.0.1", "port": 502, "timeout": 1}
@@ -42,83 +50,94 @@ DEVICES = [
 # ==== FLASK + SOCKET.IO ====
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "secret!"
-socketio = SocketIO(app, async_mode="threading", cors_allowed_origins="*")
+socketio = SocketIO(app, async_mode="eventlet", cors_allowed_origins="*", json=SIO_JSON)
 
 @app.route("/")
 def index():
     return render_template("index.html", devices=DEVICES, gateway=GATEWAY)
 
+DASHBOARD_ROOM = "dashboard"   # mọi client vào room này khi connect
+
+@socketio.on("connect")
+def on_connect():
+    join_room(DASHBOARD_ROOM)
+
+# ---- 1 kết nối TCP dùng chung tới gateway (1 bus RS485 phía sau) ----
+client = ModbusTcpClient(host=GATEWAY["host"], port=GATEWAY["port"], timeout=GATEWAY["timeout"])
+client_lock = threading.Lock()
+
+def read_registers(unit, count=6):
+    """Đọc qua client dùng chung; lock đảm bảo 1 request/lần trên socket"""
+    with client_lock:
+        if not client.connected:
+            client.connect()
+        return client.read_holding_registers(address=0, count=count, slave=unit)
+
 # ---- Worker cho từng device (1 thread/device) ----
-def reader(dev, start_epoch, timeout, barrier):
+def reader(dev, start_epoch):
     did   = dev["id"]
     unit  = int(dev["unit"])
     itv   = float(dev.get("interval", 1.0))
 
-    # Tạo client riêng cho device
-    client = ModbusTcpClient(host=GATEWAY["host"], port=GATEWAY["port"], timeout=timeout)
-    client.connect()
-
-    try:
-        # Chờ tất cả thread sẵn sàng rồi cùng nổ
-        barrier.wait()
+    # Chờ tới mốc xuất phát chung (đủ để các thread cùng nổ, không cần barrier)
+    now = time.monotonic()
+    if now < start_epoch:
+        time.sleep(start_epoch - now)
 
-        # Chờ tới mốc xuất phát chung
+    k = 0
+    while True:
+        # Lịch chống trôi theo mốc chung
+        t_sched = start_epoch + k * itv
         now = time.monotonic()
-        if now < start_epoch:
-            time.sleep(start_epoch - now)
-
-        k = 0
-        while True:
-            # Lịch chống trôi theo mốc chung
-            t_sched = start_epoch + k * itv
-            now = time.monotonic()
-            if now < t_sched:
-                time.sleep(t_sched - now)
-
-            t0 = time.perf_counter()
-            ok, data, err = False, None, None
-            try:
-                # pymodbus 3.x: dùng "slave=" cho unit_id (Modbus TCP)
-                rr = client.read_holding_registers(address=0, count=6, slave=unit)
-                if rr.isError():
-                    err = str(rr)
-                else:
-                    ok, data = True, rr.registers
-            except Exception as e:
-                err = str(e)
-
-            payload = {
-                "device_id": did,
-                "unit": unit,
-                "ok": ok,
-                "data": data,
-                "error": err,
-                "latency_ms": int((time.perf_counter() - t0) * 1000),
-                "ts": time.time(),
-            }
-            socketio.emit("modbus_update", payload, namespace="/")
-
-            # CATCH-UP: nhảy k tới mốc tương lai gần nhất để không trôi tích lũy
-            now2 = time.monotonic()
-            k = math.floor((now2 - start_epoch) / itv) + 1
-    finally:
+        if now < t_sched:
+            time.sleep(t_sched - now)
+
+        t0 = time.perf_counter()
+        ok, data, err = False, None, None
         try:
-            client.close()
-        except:
-            pass
+            # pymodbus 3.x: dùng "slave=" cho unit_id (Modbus TCP)
+            rr = read_registers(unit, count=6)
+            if rr.isError():
+                err = str(rr)
+            else:
+                ok, data = True, rr.registers
+        except Exception as e:
+            err = str(e)
+
+        payload = {
+            "device_id": did,
+            "unit": unit,
+            "ok": ok,
+            "data": data,
+            "error": err,
+            "latency_ms": int((time.perf_counter() - t0) * 1000),
+            "ts": time.time(),
+        }
+        socketio.emit("modbus_update", payload, to=DASHBOARD_ROOM, namespace="/")
+
+        # CATCH-UP: nhảy k tới mốc tương lai gần nhất để không trôi tích lũy
+        now2 = time.monotonic()
+        k = math.floor((now2 - start_epoch) / itv) + 1
 
 def start_poller():
-    # Mốc xuất phát chung (giây kế tiếp) + barrier đồng bộ
+    # Mốc xuất phát chung (giây kế tiếp)
     start_epoch = math.ceil(time.monotonic()) + 1
-    barrier = threading.Barrier(len(DEVICES))
+
+    with client_lock:
+        client.connect()
 
     for dev in DEVICES:
         threading.Thread(
             target=reader,
-            args=(dev, start_epoch, GATEWAY["timeout"], barrier),
+            args=(dev, start_epoch),
             daemon=True
         ).start()
 
+def create_app():
+    # gunicorn gọi hàm này (xem lệnh chạy ở đầu file)
+    start_poller()
+    return app
+
 if __name__ == "__main__":
     start_poller()
-    socketio.run(app, host="0.0.0.0", port=5000, debug=True)
+    socketio.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,10 @@
+# sio_json.py
+# Codec JSON cho Socket.IO dùng chung giữa các script test: orjson nếu có, không thì json stdlib
+try:
+    import orjson
+except ImportError:
+    import json as SIO_JSON
+else:
+    import types
+    SIO_JSON = types.SimpleNamespace(dumps=lambda o, *a, **kw: orjson.dumps(o).decode(),
+                                     loads=lambda s, *a, **kw: orjson.loads(s))
@@ -1,17 +1,17 @@
 # async_modbus_30.py
-import asyncio, math, time
+import asyncio, heapq, math, random, socket, struct, time
+from array import array
 from dataclasses import dataclass
-from collections import defaultdict
-from contextlib import asynccontextmanager
+from collections import defaultdict, deque
 
-from pymodbus.client import AsyncModbusTcpClient
 from pymodbus.exceptions import ModbusException
 
 import socketio  # python-socketio (ASGI)
 from starlette.applications import Starlette
-from starlette.responses import HTMLResponse
+from starlette.responses import Response
 from starlette.routing import Route
-from uvicorn import run as uvicorn_run
+import uvicorn
+from sio_json import SIO_JSON
 
 
 # ===================== CẤU HÌNH =====================
@@ -20,7 +20,22 @@ GATEWAY_PORT = 502
 NUM_UNITS = 30                 # unit_id 1..30
 INTERVAL_SEC = 1.0             # mỗi thiết bị đọc mỗi 1s (đổi tùy nhu cầu)
 TIMEOUT_SEC = 0.7              # timeout mỗi lần đọc
-PER_HOST_LIMIT = 1             # 1 request một lúc cho TCP->RS485 gateway
+PER_HOST_LIMIT = 1             # 1 request một lúc cho TCP->RS485 gateway; chỉ tăng (pipeline
+                               # nhiều request theo TID trên 1 kết nối) nếu gateway xếp hàng được
+READ_COUNT = 6                 # số thanh ghi đọc mỗi thiết bị
+
+# Gateway có "unit tổng" trả thanh ghi của mọi slave liền nhau (unit thứ i ở địa chỉ
+# i*READ_COUNT) -> đọc cả nhóm bằng vài FC03 (<= 125 thanh ghi/request).
+# Gateway không hỗ trợ: lần đầu lỗi sẽ tự quay về đọc từng unit.
+COALESCE = False
+GATEWAY_UNIT = 0
+MAX_READ_REGS = 125
+
+# Gateway lỗi liên tục (cả tick chỉ có timeout/lỗi kết nối): giãn chu kỳ của host
+# theo interval * 2^failures (tối đa BACKOFF_MAX_SEC) + jitter, có trả lời lại thì về bình thường
+BACKOFF_MAX_FAILURES = 5
+BACKOFF_MAX_SEC = 30.0
+BACKOFF_JITTER_SEC = 0.1
 
 # ===================== MÔ TẢ THIẾT BỊ =====================
 @dataclass
@@ -42,7 +57,11 @@ DEVICES: list[Device] = [
 
 
 # ===================== SOCKET.IO + WEB =====================
-sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
+# Gói update nhỏ + gửi liên tục: nén không đáng công (http_compression cho long-polling;
+# permessage-deflate của WebSocket tắt ở uvicorn.Config bên dưới)
+# logger/engineio_logger=False: không format log cho mỗi packet
+sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*", json=SIO_JSON,
+                           http_compression=False, logger=False, engineio_logger=False)
 
 # 10 phần tử mỗi hàng + UI giống dashboard trước
 INDEX_HTML = """<!doctype html>
@@ -125,83 +144,336 @@ INDEX_HTML = """<!doctype html>
       else { el.textContent = "waiting…"; }
     }
 
-    socket.on("connect", () => console.log("connected"));
+    // chỉ nhận update của các card đang có trên trang (1 room / thiết bị); gửi lại khi reconnect
+    socket.on("connect", () => {
+      console.log("connected");
+      socket.emit("subscribe", Array.from(document.querySelectorAll(".card"), el => el.id.slice(5)));
+    });
+
+    // data = bytes uint16 little-endian (Socket.IO binary attachment -> ArrayBuffer)
+    function regsText(buf) {
+      const dv = new DataView(buf);
+      const vals = new Array(buf.byteLength >> 1);
+      for (let i = 0; i < vals.length; i++) vals[i] = dv.getUint16(i * 2, true);
+      return vals.join(", ");
+    }
+
+    // thông tin cố định của thiết bị: nhận 1 lần khi connect (devices_meta),
+    // update chỉ gồm [dev_idx, seq, ok, data, error, latency_ms, ts]
+    let DEVICES_META = [];
+    socket.on("devices_meta", meta => { DEVICES_META = meta; });
 
-    socket.on("modbus_update", (msg) => {
-      const id = msg.device_id;
+    function applyOne(u) {
+      const [idx, seq, ok, data, error, latency_ms, ts] = u;
+      const meta = DEVICES_META[idx];
+      if (!meta) return;
+      const id = meta.id;
       const regsEl = document.getElementById(`regs-${id}`);
       const tsEl = document.getElementById(`ts-${id}`);
       const latEl = document.getElementById(`lat-${id}`);
       const seqEl = document.getElementById(`seq-${id}`);
 
-      if (msg.ok) {
+      if (ok) {
         setPill(id, true);
-        if (Array.isArray(msg.data) && msg.data.length) {
-          regsEl.textContent = msg.data.join(", ");
+        if (data && data.byteLength) {
+          regsEl.textContent = regsText(data);
         } else {
           regsEl.textContent = "[empty]";
         }
       } else {
         setPill(id, false, "ERR");
-        regsEl.textContent = msg.error || "error";
+        regsEl.textContent = error || "error";
       }
-      if (typeof msg.latency_ms === "number") latEl.textContent = msg.latency_ms;
-      if (typeof msg.ts === "number") tsEl.textContent = fmtTs(msg.ts);
-      if (typeof msg.seq === "number") seqEl.textContent = msg.seq;
+      if (typeof latency_ms === "number") latEl.textContent = latency_ms;
+      if (typeof ts === "number") tsEl.textContent = fmtTs(ts);
+      if (typeof seq === "number") seqEl.textContent = seq;
 
       pulse(id);
-    });
+    }
+    socket.on("modbus_update", applyOne);
+    socket.on("modbus_update_batch", arr => arr.forEach(applyOne));
   </script>
 </body>
 </html>
 """
 
+# Trang tĩnh -> render + encode 1 lần lúc import, mỗi GET chỉ trả lại bytes có sẵn
+_INDEX_BYTES = INDEX_HTML.replace("{{HOST}}", GATEWAY_HOST).replace("{{PORT}}", str(GATEWAY_PORT)).encode("utf-8")
+_INDEX_HEADERS = {"content-type": "text/html; charset=utf-8", "cache-control": "public, max-age=60"}
+
 # Starlette route "/" trả HTML
 async def index(_request):
-    html = INDEX_HTML.replace("{{HOST}}", GATEWAY_HOST).replace("{{PORT}}", str(GATEWAY_PORT))
-    return HTMLResponse(html)
+    return Response(_INDEX_BYTES, headers=_INDEX_HEADERS)
 
 starlette_app = Starlette(routes=[Route("/", index)])
 app = socketio.ASGIApp(sio, other_asgi_app=starlette_app)
 
 
+DEVICE_IDS = frozenset(d.id for d in DEVICES)
+DEVICE_INDEX = {d.id: i for i, d in enumerate(DEVICES)}
+# Phần cố định của mọi update: gửi 1 lần khi client connect, update chỉ mang dev_idx
+DEVICES_META = [{"id": d.id, "host": d.host, "unit": d.unit} for d in DEVICES]
+
+@sio.event
+async def connect(sid, environ):
+    await sio.emit("devices_meta", DEVICES_META, to=sid)
+
+# Tập device_id mỗi client đang subscribe; client cùng tập dùng chung 1 room
+# -> mỗi lần flush broadcaster gửi đúng 1 frame cho mỗi client
+client_subs: dict[str, frozenset[str]] = {}
+
+def subs_room(subs: frozenset[str]) -> str:
+    return "subs:" + ",".join(sorted(subs))
+
+async def set_subs(sid, subs: frozenset[str]):
+    """Chuyển client sang room của tập subscribe mới."""
+    old = client_subs.get(sid)
+    if old == subs:
+        return
+    if old:
+        await sio.leave_room(sid, subs_room(old))
+    if subs:
+        client_subs[sid] = subs
+        await sio.enter_room(sid, subs_room(subs))
+    else:
+        client_subs.pop(sid, None)
+
+@sio.event
+async def subscribe(sid, ids):
+    """Client gửi danh sách device_id đang hiển thị -> thêm vào tập subscribe."""
+    if not isinstance(ids, list):
+        return
+    added = DEVICE_IDS.intersection(i for i in ids if isinstance(i, str))
+    await set_subs(sid, client_subs.get(sid, frozenset()) | added)
+
+@sio.event
+async def unsubscribe(sid, ids):
+    if not isinstance(ids, list):
+        return
+    await set_subs(sid, client_subs.get(sid, frozenset()).difference(i for i in ids if isinstance(i, str)))
+
+@sio.event
+async def disconnect(sid, *_):
+    client_subs.pop(sid, None)
+
+
 # ===================== QUEUE PHÁT RA WEB =====================
-broadcast_q: asyncio.Queue = asyncio.Queue(maxsize=5000)
+# deque(maxlen) tự bỏ mẫu cũ nhất khi đầy; Event báo broadcaster có dữ liệu mới
+broadcast_buf: deque = deque(maxlen=5000)
+broadcast_ev = asyncio.Event()
 
 async def broadcaster():
+    """Mỗi lần thức dậy: lấy hết update đang chờ rồi phát 1 frame "modbus_update_batch"."""
     while True:
-        event, payload = await broadcast_q.get()
+        await broadcast_ev.wait()
+        broadcast_ev.clear()
+        # cùng event loop với producer, không có await xen giữa -> lấy + xoá là nguyên tử
+        batch = list(broadcast_buf)
+        broadcast_buf.clear()
+        if not batch:
+            continue
+        # 1 frame / tập subscribe (= 1 frame / client), chỉ gồm thiết bị client đó xem
+        ids = [DEVICES[p[0]].id for p in batch]
+        for subs in set(client_subs.values()):
+            items = [p for p, i in zip(batch, ids) if i in subs]
+            if items:
+                await sio.emit("modbus_update_batch", items, room=subs_room(subs))
+
+
+# ===================== MODBUS TCP (FC03, PDU dựng sẵn) =====================
+_MBAP = struct.Struct(">HHHB")      # transaction id, protocol id (0), length, unit id
+_PDU_CACHE: dict[tuple[int, int], bytes] = {}
+
+def read_pdu(address: int, count: int) -> bytes:
+    """PDU FC03 (5 byte) cho (address, count): encode 1 lần, các lần sau lấy từ cache."""
+    pdu = _PDU_CACHE.get((address, count))
+    if pdu is None:
+        pdu = _PDU_CACHE[(address, count)] = struct.pack(">BHH", 3, address, count)
+    return pdu
+
+class ModbusTcpPipe(asyncio.Protocol):
+    """
+    Client Modbus TCP tối giản chỉ cho FC03: mỗi request = MBAP (đóng TID + unit)
+    + PDU dựng sẵn, ghi thẳng vào transport; response ghép về future theo TID
+    nên nhiều request bay cùng lúc trên 1 kết nối (pipeline).
+    """
+    def __init__(self):
+        self.transport: asyncio.Transport | None = None
+        self.connected = False
+        self._buf = bytearray()
+        self._pending: dict[int, asyncio.Future] = {}
+        self._tid = 0
+
+    @classmethod
+    async def open(cls, host: str, port: int) -> "ModbusTcpPipe":
+        _transport, proto = await asyncio.get_running_loop().create_connection(cls, host, port)
+        return proto
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected = True
+
+    def connection_lost(self, exc):
+        self.connected = False
+        err = ConnectionError(f"connection lost: {exc!r}")
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(err)
+        self._pending.clear()
+
+    def data_received(self, data):
+        buf = self._buf
+        buf += data
+        while len(buf) >= 7:
+            tid, _proto, length, _unit = _MBAP.unpack_from(buf)
+            end = 6 + length
+            if len(buf) < end:
+                break
+            pdu = bytes(buf[7:end])
+            del buf[:end]
+            fut = self._pending.pop(tid, None)
+            if fut is not None and not fut.done():
+                fut.set_result(pdu)
+
+    async def read_holding_registers(self, address: int, count: int, unit: int) -> bytes:
+        """Trả về phần dữ liệu thanh ghi của response (big-endian, 2 byte/thanh ghi)."""
+        self._tid = tid = (self._tid + 1) & 0xFFFF
+        pdu = read_pdu(address, count)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[tid] = fut
+        self.transport.write(_MBAP.pack(tid, 0, len(pdu) + 1, unit) + pdu)
         try:
-            await sio.emit(event, payload)  # phát cho tất cả client
+            resp = await fut
         finally:
-            broadcast_q.task_done()
+            self._pending.pop(tid, None)    # timeout/huỷ: response đến muộn sẽ bị bỏ
+        if resp[0] & 0x80:
+            raise ModbusException(f"unit {unit}: exception code {resp[1] if len(resp) > 1 else '?'}")
+        return resp[2:2 + resp[1]]
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
 
 
 # ===================== POOL THEO HOST =====================
+class _CondSlot:
+    """
+    Giới hạn số request đang bay: bộ đếm + asyncio.Condition.
+    `limit` đổi được lúc chạy (tăng thì đánh thức task đang chờ).
+    """
+    def __init__(self, limit: int):
+        self._limit = limit
+        self.active = 0
+        self.cond = asyncio.Condition()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    async def set_limit(self, limit: int):
+        async with self.cond:
+            self._limit = limit
+            self.cond.notify_all()
+
+    async def __aenter__(self):
+        async with self.cond:
+            while self.active >= self._limit:
+                await self.cond.wait()
+            self.active += 1
+
+    async def __aexit__(self, *exc):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify(1)
+
 class HostPool:
-    def __init__(self, host, port, max_concurrent=1):
+    def __init__(self, host, port, max_concurrent=1, connect_timeout=TIMEOUT_SEC):
         self.host = host
         self.port = port
-        self.sem = asyncio.Semaphore(max_concurrent)
-        self.client: AsyncModbusTcpClient | None = None
-        self.lock = asyncio.Lock()
-
-    @asynccontextmanager
-    async def session(self):
-        # đảm bảo có client (lazy connect)
-        async with self.lock:
-            if self.client is None:
-                self.client = AsyncModbusTcpClient(host=self.host, port=self.port)
-                await self.client.connect()
+        self.connect_timeout = connect_timeout
+        # 1 request/lúc: Lock là đủ; pipeline nhiều request: bộ đếm có điều kiện
+        self.sem = asyncio.Lock() if max_concurrent == 1 else _CondSlot(max_concurrent)
+        self.client: ModbusTcpPipe | None = None     # 1 kết nối dùng chung cho mọi thiết bị
+        self.failures = 0       # số tick lỗi liên tiếp (backoff dùng chung cho cả host)
+        self._connecting: asyncio.Future | None = None
+
+    async def connect_once(self) -> ModbusTcpPipe:
+        """
+        Đã kết nối: trả client ngay (không lock). Chưa có: chỉ 1 task mở kết nối,
+        các task khác chờ chung kết quả đó (kể cả lỗi).
+        """
+        client = self.client
+        if client is not None and client.connected:
+            return client
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open())
+        fut = self._connecting
         try:
-            yield self.client
-        except Exception:
+            # shield: task chờ bị huỷ/timeout không huỷ lần connect dùng chung
+            return await asyncio.shield(fut)
+        finally:
+            if fut.done() and self._connecting is fut:
+                self._connecting = None
+
+    async def _open(self) -> ModbusTcpPipe:
+        self._drop()
+        # có timeout: gateway im lặng không treo cả tick (~2 phút SYN retry của OS)
+        client = await asyncio.wait_for(ModbusTcpPipe.open(self.host, self.port),
+                                        self.connect_timeout)
+        self._tune_socket(client)
+        self.client = client
+        return client
+
+    @staticmethod
+    def _tune_socket(client: ModbusTcpPipe):
+        # TCP_NODELAY: PDU Modbus nhỏ không bị Nagle giữ lại;
+        # SO_KEEPALIVE: phát hiện gateway chết khi không có request
+        sock = client.transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def _drop(self):
+        # lỗi kết nối -> bỏ kết nối, lần đọc sau sẽ connect lại
+        if self.client is not None:
             try:
-                await self.client.close()
-            except:
+                self.client.close()
+            except Exception:
                 pass
             self.client = None
-            raise
+
+    async def read(self, unit: int, timeout: float, address: int = 0, count: int = READ_COUNT):
+        """
+        Đọc 1 lần: sem + client dùng lại + timeout gộp trong 1 hàm
+        (thay cho 3 context manager lồng nhau mỗi tick).
+        """
+        async with self.sem:            # giới hạn số request đang bay theo host
+            client = await self.connect_once()
+            try:
+                return await asyncio.wait_for(read_once(client, unit, address, count), timeout)
+            except (ModbusException, asyncio.TimeoutError):
+                # exception response / 1 thiết bị chậm: response trễ bị bỏ qua theo TID,
+                # kết nối vẫn dùng được cho các request khác đang bay
+                raise
+            except Exception:
+                # lỗi kết nối thật -> bỏ kết nối, lần đọc sau connect lại
+                self._drop()
+                raise
+
+    async def coalesce_read(self, n_units: int, timeout: float, count: int = READ_COUNT):
+        """
+        Đọc n_units thiết bị liền nhau qua GATEWAY_UNIT bằng ít FC03 nhất
+        (chia theo MAX_READ_REGS) rồi cắt lại -> list thanh ghi cho từng thiết bị.
+        """
+        per_req = max(1, MAX_READ_REGS // count)     # số thiết bị / 1 request
+        chunks = await asyncio.gather(*(
+            self.read(GATEWAY_UNIT, timeout, i * count, min(per_req, n_units - i) * count)
+            for i in range(0, n_units, per_req)
+        ))
+        regs = array("H")
+        for chunk in chunks:
+            regs.extend(chunk)
+        return [regs[i * count:(i + 1) * count] for i in range(n_units)]
 
 host_pools: dict[tuple[str, int], HostPool] = {}
 
@@ -213,87 +485,185 @@ def get_pool(host, port, per_host_limit=1) -> HostPool:
 
 
 # ===================== LỊCH CHỐNG TRÔI + PHASE =====================
-def init_next_run(interval: float, unit: int) -> float:
+def init_next_run(interval: float, unit: int, now: float) -> float:
     # phase nhỏ vài ms để tránh dồn xung cùng lúc trên gateway
+    # now: theo đồng hồ của event loop (loop.time())
     phase = min(0.02, interval / 10.0) * ((unit % 10) / 10.0)
-    now = time.monotonic()
     base = math.floor((now - phase) / interval) * interval + phase
     return base if base > now else base + interval
 
 
 # ===================== ĐỌC 1 LẦN (đổi tùy nhu cầu) =====================
-async def read_once(client: AsyncModbusTcpClient, unit: int):
-    rr = await client.read_holding_registers(0, 6, unit=unit)  # đọc 6 thanh ghi
-    if rr.isError():
-        raise ModbusException(str(rr))
-    return rr.registers
-
-
-# ===================== TASK CHO MỖI THIẾT BỊ =====================
-async def poll_device(dev: Device, per_host_limit=1):
-    pool = get_pool(dev.host, dev.port, per_host_limit=per_host_limit)
-    next_run = init_next_run(dev.interval, dev.unit)
-    seq = 0
+async def read_once(client: ModbusTcpPipe, unit: int, address: int = 0, count: int = READ_COUNT):
+    data = await client.read_holding_registers(address, count, unit)
+    # array('H') trên bytes big-endian của Modbus rồi byteswap -> .tobytes() luôn là
+    # little-endian như frontend đọc (giá trị phần tử chỉ đúng trên máy little-endian)
+    regs = array("H", data)
+    regs.byteswap()
+    return regs
+
+
+# ===================== ĐỌC THEO HOST + SCHEDULER =====================
+def new_payload(dev: Device) -> list:
+    """
+    Update dựng sẵn 1 lần cho mỗi thiết bị, dạng vị trí:
+    [dev_idx, seq, ok, data, error, latency_ms, ts] (id/host/unit nằm trong devices_meta).
+    """
+    return [DEVICE_INDEX[dev.id], 0, False, None, None, 0, 0.0]
+
+# Mốc (wall, perf_counter) chụp cùng lúc: ts = wall0 + (perf - perf0) -> mỗi update chỉ
+# đọc đồng hồ 1 lần; clock_resync() chụp lại định kỳ để không trôi so với giờ hệ thống
+CLOCK_RESYNC_SEC = 60
+_clock_base = [time.time(), time.perf_counter()]
+
+async def clock_resync():
     while True:
-        now = time.monotonic()
-        if now < next_run:
-            await asyncio.sleep(next_run - now)
-
-        t0 = time.perf_counter()
-        ok, data, err = False, None, None
-        try:
-            async with pool.sem:            # giới hạn song song theo host
-                async with pool.session() as client:
-                    async with asyncio.timeout(dev.timeout):
-                        data = await read_once(client, dev.unit)
-                        ok = True
-        except Exception as e:
-            err = repr(e)
-
-        seq += 1
-        payload = {
-            "device_id": dev.id,
-            "host": dev.host,
-            "unit": dev.unit,
-            "ok": ok,
-            "data": data,
-            "error": err,
-            "seq": seq,
-            "latency_ms": int((time.perf_counter() - t0) * 1000),
-            "ts": time.time(),
-        }
-
-        # đẩy ra broadcaster (nếu đầy, giữ mẫu mới nhất)
+        await asyncio.sleep(CLOCK_RESYNC_SEC)
+        _clock_base[:] = (time.time(), time.perf_counter())
+
+def publish(payload: list, seq: int, ok: bool, data, err, t0: float,
+            _perf=time.perf_counter, _base=_clock_base,
+            _append=broadcast_buf.append, _notify=broadcast_ev.set):
+    # _perf/_base/_append/_notify: gắn sẵn lúc định nghĩa hàm -> biến local mỗi lần gọi
+    now = _perf()
+    payload[1] = seq
+    payload[2] = ok
+    payload[3] = data.tobytes() if data is not None else None
+    payload[4] = err
+    payload[5] = int((now - t0) * 1000)
+    payload[6] = _base[0] + (now - _base[1])
+
+    # đẩy bản sao ra broadcaster (emit là async, payload gốc bị ghi đè ở tick sau);
+    # nếu đầy, deque tự bỏ mẫu cũ nhất
+    _append(payload.copy())
+    _notify()
+
+async def poll_once(dev: Device, payload: list, pool: HostPool, seq: int, _perf=time.perf_counter):
+    """Đọc + publish 1 thiết bị; trả True nếu gateway có trả lời (kể cả exception response)."""
+    t0 = _perf()
+    ok, data, err = False, None, None
+    answered = True
+    try:
+        data = await pool.read(dev.unit, dev.timeout)
+        ok = True
+    except ModbusException as e:
+        err = repr(e)           # thiết bị từ chối request (VD exception 02): gateway vẫn sống
+    except Exception as e:
+        err = repr(e)
+        answered = False        # timeout / lỗi kết nối
+    publish(payload, seq, ok, data, err, t0)
+    return answered
+
+class HostJob:
+    """
+    Việc đọc của 1 host (gateway): mỗi tick gửi đồng loạt request của mọi thiết bị
+    trên kết nối chung, số request đang bay <= PER_HOST_LIMIT (mặc định 1: tuần tự).
+    Pipeline là tuỳ chọn: tăng PER_HOST_LIMIT thì ModbusTcpPipe ghép response theo
+    Transaction ID (MBAP), N request tốn ~N/PER_HOST_LIMIT RTT. Chu kỳ = interval nhỏ nhất của nhóm.
+    """
+    def __init__(self, pool: HostPool, devices: list[Device]):
+        self.pool = pool
+        self.slots = [(d, new_payload(d)) for d in devices]
+        self.interval = min(d.interval for d in devices)
+        self.timeout = max(d.timeout for d in devices)
+        self.coalesce = COALESCE
+        self.seq = 0
+        self.busy = False           # tick trước chưa xong -> bỏ tick này
+
+    async def tick(self, _perf=time.perf_counter, _gather=asyncio.gather):
         try:
-            broadcast_q.put_nowait(("modbus_update", payload))
-        except asyncio.QueueFull:
-            _ = await broadcast_q.get()
-            broadcast_q.task_done()
-            await broadcast_q.put(("modbus_update", payload))
-
-        # lịch tick kế tiếp + bắt kịp nếu trễ
-        next_run += dev.interval
-        while time.monotonic() >= next_run:
-            next_run += dev.interval
+            self.seq += 1
+            seq, pool, slots = self.seq, self.pool, self.slots
+            per_dev = None
+            if self.coalesce:
+                t0 = _perf()
+                try:
+                    per_dev = await pool.coalesce_read(len(slots), self.timeout)
+                except ModbusException:
+                    self.coalesce = False   # gateway không hỗ trợ -> đọc từng unit từ nay
+                except Exception:
+                    pass                    # timeout/mất kết nối: tick này đọc từng unit
+            if per_dev is not None:
+                for (_d, payload), data in zip(slots, per_dev):
+                    publish(payload, seq, True, data, None, t0)
+                answered = True
+            else:
+                answered = any(await _gather(*(poll_once(d, payload, pool, seq) for d, payload in slots)))
+            # cả tick chỉ có timeout/lỗi kết nối -> coi như gateway lỗi: backoff + bỏ kết nối
+            # (có thể đã chết im lặng) để tick sau connect lại
+            pool.failures = 0 if answered else min(pool.failures + 1, BACKOFF_MAX_FAILURES)
+            if not answered:
+                pool._drop()
+        finally:
+            self.busy = False
+
+async def scheduler(jobs: list[HostJob]):
+    """
+    1 coroutine lập lịch cho mọi host bằng min-heap (next_run, idx): lấy job đến hạn
+    sớm nhất, đẩy lại mốc kế tiếp (O(log N)) rồi tạo task tick.
+    Trễ thì bỏ các mốc đã qua bằng 1 phép chia (không lặp từng mốc).
+    Host đang lỗi (pool.failures > 0): mốc kế tiếp giãn theo backoff.
+    """
+    loop = asyncio.get_running_loop()
+    clock = loop.time               # monotonic, cùng đồng hồ với asyncio.sleep
+    # hàm dùng mỗi tick -> biến local (LOAD_FAST thay vì LOAD_GLOBAL/LOAD_ATTR)
+    sleep, heapreplace, create_task = asyncio.sleep, heapq.heapreplace, loop.create_task
+    now = clock()
+    heap = [(init_next_run(job.interval, i, now), i) for i, job in enumerate(jobs)]
+    heapq.heapify(heap)
+    running = set()     # giữ tham chiếu task tick (tránh bị GC giữa chừng)
+    while heap:
+        next_run, i = heap[0]
+        now = clock()
+        if now < next_run:
+            await sleep(next_run - now)
+            now = clock()
+
+        job = jobs[i]
+        itv = job.interval
+        failures = job.pool.failures
+        if failures:
+            next_run = now + min(itv * (1 << failures), BACKOFF_MAX_SEC) + random.random() * BACKOFF_JITTER_SEC
+        else:
+            next_run += (max(0, int((now - next_run) // itv)) + 1) * itv
+        heapreplace(heap, (next_run, i))
+        if not job.busy:
+            job.busy = True
+            task = create_task(job.tick())
+            running.add(task)
+            task.add_done_callback(running.discard)
 
 
 # ===================== MAIN =====================
 async def main():
-    # chạy broadcaster
+    # chạy broadcaster + đồng bộ lại mốc đồng hồ
     asyncio.create_task(broadcaster())
+    asyncio.create_task(clock_resync())
 
-    # tạo task cho 30 thiết bị
-    tasks = [asyncio.create_task(poll_device(d, PER_HOST_LIMIT)) for d in DEVICES]
+    # 1 job cho mỗi host (gateway), gom thiết bị theo (host, port); 1 scheduler cho tất cả
+    by_host = defaultdict(list)
+    for d in DEVICES:
+        by_host[(d.host, d.port)].append(d)
+    jobs = [HostJob(get_pool(h, p, PER_HOST_LIMIT), devs) for (h, p), devs in by_host.items()]
+    tasks = [asyncio.create_task(scheduler(jobs))]
 
-    # chạy ASGI server
-    server = asyncio.create_task(asyncio.to_thread(
-        uvicorn_run, app, host="0.0.0.0", port=8000, log_level="info"
-    ))
+    # chạy ASGI server ngay trên event loop này (emit + HTTP/WebSocket chung 1 loop,
+    # không qua thread thứ 2)
+    # log_level="warning" + tắt access log: không format 1 dòng log cho mỗi request
+    config = uvicorn.Config(app, host="0.0.0.0", port=8000, log_level="warning",
+                            access_log=False, ws_per_message_deflate=False)
+    server = uvicorn.Server(config)
 
-    await asyncio.gather(*tasks, server)
+    await asyncio.gather(*tasks, server.serve())
 
 
 if __name__ == "__main__":
+    # uvloop (nếu có) thay event loop mặc định: I/O socket + timer nhanh hơn
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     try:
         asyncio.run(main())
     except KeyboardInterrupt: